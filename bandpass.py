@@ -0,0 +1,74 @@
+import os
+import numpy as np
+from utils import greybody_kernel
+
+c = 299792458.0 # m/s
+
+#Two-column ASCII files: wavelength [microns], relative spectral response
+filter_files = {'MIPS_24':'mips_24.txt', 'MIPS_70':'mips_70.txt', 'MIPS_160':'mips_160.txt',
+    'PACS_70':'pacs_70.txt', 'PACS_100':'pacs_100.txt', 'PACS_160':'pacs_160.txt',
+    'SPIRE_250':'spire_250.txt', 'SPIRE_350':'spire_350.txt', 'SPIRE_500':'spire_500.txt',
+    'SCUBA2_450':'scuba2_450.txt', 'SCUBA2_850':'scuba2_850.txt',
+    'AzTEC_1100':'aztec_1100.txt'}
+
+nominal_wavelengths = {'MIPS_24':23.68, 'MIPS_70':71.42, 'MIPS_160':155.9,
+    'PACS_70':70.0, 'PACS_100':100.0, 'PACS_160':160.0,
+    'SPIRE_250':250.0, 'SPIRE_350':350.0, 'SPIRE_500':500.0,
+    'SCUBA2_450':450.0, 'SCUBA2_850':850.0,
+    'AzTEC_1100':1100.0}
+
+#Photon-counting detectors respond to photon rate, so their response is weighted by 1/nu
+photon_counters = ['MIPS_24', 'MIPS_70', 'MIPS_160']
+
+class Bandpasses:
+
+    def __init__(self, bands, fpath='/data/filters/', files=filter_files, nfreq=4000, lambda_min=5., lambda_max=3000., reference_index=-1.0):
+        ''' Filter response curves resampled once onto a shared log-spaced frequency grid,
+        stored as a band-weight matrix so that band-averaged fluxes of N SEDs are one matrix product.
+
+        Fluxes follow the usual quoted-flux convention: the band average is normalized so that a
+        source with S ~ nu^reference_index (default -1, i.e. nu S_nu flat) returns its flux density
+        at the nominal wavelength.  color_corrections then gives, per SED, the factor the scalar
+        color_correction in Skymaps approximates.
+        '''
+        self.bands = list(bands)
+        self.reference_index = reference_index
+        self.nu = c * 1.e6 / np.logspace(np.log10(lambda_max), np.log10(lambda_min), nfreq) # Hz, increasing
+        dnu = np.gradient(self.nu)
+        self.nu0 = np.array([c * 1.e6 / nominal_wavelengths[band] for band in self.bands])
+
+        self.weights = np.zeros([len(self.bands), nfreq])
+        for i, band in enumerate(self.bands):
+            lam, response = np.loadtxt(os.path.join(fpath, files[band]), unpack=True, usecols=(0,1))
+            order = np.argsort(c * 1.e6 / lam)
+            rsrf = np.interp(self.nu, c * 1.e6 / lam[order], response[order], left=0.0, right=0.0)
+            if band in photon_counters:
+                rsrf *= self.nu0[i] / self.nu
+            norm = np.sum(rsrf * dnu * (self.nu / self.nu0[i])**reference_index)
+            self.weights[i] = rsrf * dnu / norm
+
+    def band_fluxes(self, seds):
+        ''' Band-averaged fluxes [N, nbands] of SEDs [N, nfreq] evaluated on self.nu '''
+        return np.dot(seds, self.weights.T)
+
+    def greybody_band_fluxes(self, A, T, betain=1.8, alphain=2.0, chunk_size=1000):
+        ''' Band-averaged fluxes [N, nbands] (mJy) of greybody_kernel SEDs, chunk_size SEDs at a time '''
+        T = np.ravel(T)
+        A, T = np.broadcast_arrays(np.ravel(A), T)
+        betain = np.broadcast_to(np.asarray(betain, dtype=float), np.shape(T))
+        alphain = np.broadcast_to(np.asarray(alphain, dtype=float), np.shape(T))
+        fluxes = np.zeros([len(T), len(self.bands)])
+        for i in range(0, len(T), chunk_size):
+            sl = slice(i, i + chunk_size)
+            fluxes[sl] = self.band_fluxes(greybody_kernel(A[sl], T[sl], self.nu, betain[sl], alphain[sl]))
+        return fluxes
+
+    def color_corrections(self, T, betain=1.8, alphain=2.0):
+        ''' Ratio of band-averaged to monochromatic (at the nominal wavelength) flux, [N, nbands],
+        for greybodies of observed temperature T.  Divide measured band fluxes by it to recover
+        monochromatic flux densities.
+        '''
+        T = np.ravel(T)
+        band = self.greybody_band_fluxes(1.0, T, betain, alphain)
+        monochromatic = greybody_kernel(1.0, T, self.nu0, betain, alphain)
+        return band / monochromatic
@@ -0,0 +1,88 @@
+import os
+import numpy as np
+from invert_sed import amplitude_from_greybody
+from invert_sed import AmplitudeTable
+from invert_sed import sed_direct
+from utils import luminosity_conversion
+
+c = 299792458.0 # m/s
+
+def axes_file(filename):
+    return os.path.splitext(filename)[0] + '_axes.npz'
+
+def build_flux_tensor(filename, lambdavector, z_grid, Trf_grid, betain=2.0, alphain=2.0):
+    ''' Fill a .npy memmap at filename with observed-frame band fluxes of the invert_sed greybody
+    (sed_direct, Planck15 distances) on a (z, T_rf, band) grid, and save the axes next to it.
+    Flux is exactly proportional to L_IR / (4 pi D_L^2), so the table holds
+    log10(flux * luminosity_conversion(z)) for L_IR = 1 L_sun; both factors are applied analytically
+    at lookup, leaving only the smooth dependence on T_obs = T_rf/(1+z) to interpolate.
+    Returns the FluxTensor, opened read-only.
+    '''
+    z_grid = np.ravel(np.asarray(z_grid, dtype=np.float64))
+    Trf_grid = np.ravel(np.asarray(Trf_grid, dtype=np.float64))
+    lambdavector = np.ravel(np.asarray(lambdavector, dtype=np.float64))
+    nuvector = c * 1.e6 / lambdavector # Hz
+
+    Tobs = Trf_grid[None,:] / (1. + z_grid[:,None])
+    table = AmplitudeTable(betas = [betain], alphain = alphain, T_min = 0.9 * np.min(Tobs), T_max = 1.1 * np.max(Tobs))
+
+    tensor = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float64,
+        shape=(len(z_grid), len(Trf_grid), len(nuvector)))
+    for iz in range(len(z_grid)):
+        amplitude = amplitude_from_greybody(Trf_grid, 1.0, z_grid[iz], b = betain, alphain = alphain, table = table)
+        with np.errstate(divide='ignore'):
+            tensor[iz] = np.log10(sed_direct(amplitude, nuvector, Tobs[iz], betain, alphain) * luminosity_conversion(z_grid[iz]))
+    tensor.flush()
+    del tensor
+
+    np.savez(axes_file(filename), z=z_grid, Trf=Trf_grid, wavelengths=lambdavector,
+        betain=betain, alphain=alphain)
+
+    return FluxTensor(filename)
+
+class FluxTensor:
+
+    def __init__(self, filename):
+        ''' Read-only view of a tensor written by build_flux_tensor.  The table is memory-mapped,
+        so worker processes share the OS page cache instead of holding copies; pickling a
+        FluxTensor (e.g. to send it to a Pool) only passes the filename.
+        '''
+        self.filename = filename
+        self.tensor = np.load(filename, mmap_mode='r')
+        axes = np.load(axes_file(filename))
+        self.z = axes['z']
+        self.Trf = axes['Trf']
+        self.wavelengths = axes['wavelengths']
+        self.betain = float(axes['betain'])
+        self.alphain = float(axes['alphain'])
+        self.log_1pz = np.log(1. + self.z)
+        self.log_Trf = np.log(self.Trf)
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def bracket(self, nodes, values, name):
+        if np.any((values < nodes[0]) | (values > nodes[-1])):
+            raise ValueError("{} outside the flux tensor range [{}, {}]".format(name, nodes[0], nodes[-1]))
+        i = np.clip(np.searchsorted(nodes, values, side='right') - 1, 0, len(nodes) - 2)
+        f = (values - nodes[i]) / (nodes[i+1] - nodes[i])
+        return i, f
+
+    def lookup(self, zin, Trf, logL):
+        ''' Fluxes (mJy), [ngal, nbands], for catalog arrays of (z, T_rf, log10 L_IR).
+        The table is bilinearly interpolated in (log(1+z), log T_rf); L_IR and the
+        luminosity distance are applied exactly.
+        '''
+        zin, Trf, logL = np.broadcast_arrays(np.ravel(zin), np.ravel(Trf), np.ravel(logL))
+        iz, fz = self.bracket(self.log_1pz, np.log(1. + zin), 'z')
+        iT, fT = self.bracket(self.log_Trf, np.log(Trf), 'Trf')
+
+        log_flux = np.zeros([len(zin), len(self.wavelengths)])
+        for dz, wz in [(0, 1. - fz), (1, fz)]:
+            for dT, wT in [(0, 1. - fT), (1, fT)]:
+                log_flux += (wz * wT)[:,None] * self.tensor[iz+dz, iT+dT]
+
+        return 10**(log_flux + logL[:,None]) / luminosity_conversion(zin)[:,None]
@@ -1,8 +1,12 @@
 import pdb
 import numpy as np
 import cPickle as pickle
+from itertools import izip
+from multiprocessing import Pool
 from utils import black
+from utils import greybody_kernel
 from utils import loggen
+from utils import luminosity_conversion
 #from astropy.cosmology import FlatLambdaCDM
 from astropy.cosmology import Planck15 as cosmo
 import astropy.units as u
@@ -11,6 +15,8 @@ from lmfit import Parameters, minimize, fit_report
 L_sun = 3.839e26 # W
 c = 299792458.0 # m/s
 
+amplitude_quadratures = {}
+
 def find_nearest_index(array_in,value):
 	ng = len(value)
 	#idx = (np.abs(array_in-value)).argmin()
@@ -28,47 +34,13 @@ def sed(p, nu_in, T, betain, alphain):
 	v = p.valuesdict()
 	A0= v['Ain']
 	A=np.asarray(A0)
-	#T = v['Tin']
-	#betain = v['betain']
-	#alphain = v['alphain']
-	ng = np.size(A)
-
-	ns = len(nu_in)
-	base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-	expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-	K = base * 10.0**expo
-	w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-	w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-	w_div = w_num/w_den
-	nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-	graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-	powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-	graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
 
-	return graybody
+	return greybody_kernel(A, T, nu_in, betain, alphain)
 
 def sed_direct(A, nu_in, T, betain, alphain):
 	'''
 	'''
-	ng = np.size(A)
-
-	ns = len(nu_in)
-	base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-	expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-	K = base * 10.0**expo
-	w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-	w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-	w_div = w_num/w_den
-	nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-	#graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(np.repeat(betain,ng),[ng,1]) * black(nu_in, T) / 1000.0
-	#powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(np.repeat(alphain,ng),[ng,1])
-	graybody = np.reshape(A,(ng,1)) * nu_in**betain * black(nu_in, T) / 1000.0
-	powerlaw = np.reshape(w_div,(ng,1)) * nu_in**(-1.0 * alphain)
-	graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
-
-	return graybody
+	return greybody_kernel(A, T, nu_in, betain, alphain)
 
 def sedint(p, nu_in, Lir, T, betain, alphain):
 	'''
@@ -82,31 +54,9 @@ def sedint(p, nu_in, Lir, T, betain, alphain):
 	v = p.valuesdict()
 	A0 = v['Ain']
 	A=np.asarray(A0)
-	#pdb.set_trace()
-	#T = v['Tin']
-	#betain = v['betain']
-	#alphain = v['alphain']
 
-
-	#print 'A is ' + str(A)
 	ns = len(nu_in)
-	#pdb.set_trace()
-	ng = np.size(A)
-	base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-	expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-	K = base * 10.0**expo
-	w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-	w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-	w_div = w_num/w_den
-	nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-	#nu_cut_ind = find_nearest_index(nu_in,nu_cut)
-
-	graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-	powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-	graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
-
-	#pdb.set_trace()
+	graybody = greybody_kernel(A, T, nu_in, betain, alphain)
 
 	dnu = nu_in[1:ns] - nu_in[0:ns-1]
 	dnu = np.append(dnu[0],dnu)
@@ -128,22 +78,7 @@ def sedint2(p, nu_in, Lir, ng): # m = [A, T, Beta, Alpha] - return integrated SE
 
 	print 'A is ' + str(A)
 	ns = len(nu_in)
-	#ng = len(A)
-	base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-	expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-	K = base * 10.0**expo
-	w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-	w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-	w_div = w_num/w_den
-	nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-	#nu_cut_ind = find_nearest_index(nu_in,nu_cut)
-
-	graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-	powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-	graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
-
-	#pdb.set_trace()
+	graybody = greybody_kernel(np.zeros(ng) + A, T, nu_in, betain, alphain)
 
 	dnu = nu_in[1:ns] - nu_in[0:ns-1]
 	dnu = np.append(dnu[0],dnu)
@@ -184,7 +119,7 @@ def simple_flux_from_greybody(lambdavector, Trf = None, b = None, Lrf = None, zi
 
 	#Lorenzo's version had: H0=70.5, Omega_M=0.274, Omega_L=0.726 (Hinshaw et al. 2009)
 	#cosmo = Planck15#(H0 = 70.5 * u.km / u.s / u.Mpc, Om0 = 0.273)
-	conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
+	conversion = luminosity_conversion(zin) # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
 
 	Lir = Lrf / conversion # Jy x Hz
 
@@ -200,8 +135,8 @@ def simple_flux_from_greybody(lambdavector, Trf = None, b = None, Lrf = None, zi
 
 	#pdb.set_trace()
 	#THE LM FIT IS HERE
-	#Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir.value,ngal))
-	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir.value,ngal,Trf/(1.+zin),b,alphain))
+	#Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir,ngal))
+	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir,ngal,Trf/(1.+zin),b,alphain))
 
 	#pdb.set_trace()
 	flux_mJy=sed(Pfin.params,nuvector,ngal,Trf/(1.+zin),b,alphain)
@@ -242,7 +177,7 @@ def single_simple_flux_from_greybody(lambdavector, Trf = None, b = 2.0, Lrf = No
 	nu_mod = c * 1.e6/lambda_mod # Hz
 
 	#cosmo = Planck15#(H0 = 70.5 * u.km / u.s / u.Mpc, Om0 = 0.273)
-	conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
+	conversion = luminosity_conversion(zin) # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
 
 	Lir = Lrf / conversion # Jy x Hz
 
@@ -254,7 +189,7 @@ def single_simple_flux_from_greybody(lambdavector, Trf = None, b = 2.0, Lrf = No
 	fit_params.add('Ain', value= Ain)
 
 	#THE LM FIT IS HERE
-	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir.value,Trf/(1.+zin),b,alphain))
+	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir,Trf/(1.+zin),b,alphain))
 
 	flux_mJy=sed(Pfin.params,nuvector,Trf/(1.+zin),b,alphain)
 
@@ -294,7 +229,7 @@ def single_simple_rest_frame_flux_from_greybody(lambdavector, Trf = None, b = 2.
 	nu_mod = c * 1.e6/lambda_mod # Hz
 
 	#cosmo = Planck15#(H0 = 70.5 * u.km / u.s / u.Mpc, Om0 = 0.273)
-	conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
+	conversion = luminosity_conversion(zin) # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
 
 	Lir = Lrf / conversion # Jy x Hz
 
@@ -306,7 +241,7 @@ def single_simple_rest_frame_flux_from_greybody(lambdavector, Trf = None, b = 2.
 	fit_params.add('Ain', value= Ain)
 
 	#THE LM FIT IS HERE
-	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir.value,Trf/(1.+zin),b,alphain))
+	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir,Trf/(1.+zin),b,alphain))
 
 	flux_mJy=sed(Pfin.params,nuvector,Trf/(1.+zin),b,alphain)
 
@@ -315,29 +250,91 @@ def single_simple_rest_frame_flux_from_greybody(lambdavector, Trf = None, b = 2.
 
 def amplitude_of_best_fit_greybody(Trf = None, b = 2.0, Lrf = None, zin = None):
 	'''
-	Same as single_simple_flux_from_greybody, but to made an amplitude lookup table
+	Same as single_simple_flux_from_greybody, but to made an amplitude lookup table.
+	Now solved exactly by amplitude_from_greybody rather than with an lmfit minimization.
 	'''
+	return amplitude_from_greybody(Trf, Lrf, zin, b = b)[0]
 
-	nsed = 1e4
-	lambda_mod = loggen(1e3, 8.0, nsed) # microns
-	nu_mod = c * 1.e6/lambda_mod # Hz
-
-	#cosmo = Planck15#(H0 = 70.5 * u.km / u.s / u.Mpc, Om0 = 0.273)
-	conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
-
-	Lir = Lrf / conversion # Jy x Hz
-
-	Ain = 1.0e-36 #good starting parameter
-	betain =  b
-	alphain=  2.0
-
-	fit_params = Parameters()
-	fit_params.add('Ain', value= Ain)
+def amplitude_quadrature(nsed = 1e4):
+	'''
+	Model frequency grid (Hz) and weights dnu that sedint integrates over, built once per nsed
+	'''
+	if nsed not in amplitude_quadratures:
+		lambda_mod = loggen(1e3, 8.0, nsed) # microns
+		nu_mod = c * 1.e6/lambda_mod # Hz
+		ns = len(nu_mod)
+		dnu = nu_mod[1:ns] - nu_mod[0:ns-1]
+		dnu = np.append(dnu[0],dnu)
+		amplitude_quadratures[nsed] = (nu_mod, dnu)
+	return amplitude_quadratures[nsed]
+
+def unit_sed_integral(Tobs, betain = 2.0, alphain = 2.0, chunk_size = 500):
+	'''
+	Integral (Jy x Hz) of the A=1 greybody at observed temperatures Tobs over the sedint grid,
+	chunk_size temperatures at a time to bound the [chunk_size, 1e4] SED memory
+	'''
+	nu_mod, dnu = amplitude_quadrature()
+	Tobs = np.ravel(Tobs)
+	integral = np.zeros(len(Tobs))
+	for i in range(0, len(Tobs), chunk_size):
+		integral[i:i+chunk_size] = np.dot(greybody_kernel(1.0, Tobs[i:i+chunk_size], nu_mod, betain, alphain), dnu)
+	return integral
+
+def amplitude_from_greybody(Trf, Lrf, zin, b = 2.0, alphain = 2.0, table = None):
+	'''
+	Exact, vectorized version of amplitude_of_best_fit_greybody for arrays of (Trf, Lrf, zin).
+	The integrated SED that sedint matches to L_IR is linear in A, so
+	A = (Lrf / 4 pi D_L^2) / integral of the A=1 SED at Tobs = Trf/(1+zin).
+	Pass table = AmplitudeTable(...) to interpolate the integral instead of evaluating it.
 
-	#THE LM FIT IS HERE
-	Pfin = minimize(sedint, fit_params, args=(nu_mod,Lir.value,Trf/(1.+zin),b,alphain))
-	#pdb.set_trace()
-	return Pfin.params['Ain'].value
+	Inputs:
+	Trf = rest-frame temperature [in K]
+	Lrf = rest-frame FIR bolometric luminosity [in L_sun]
+	zin = galaxy redshift
+	b = spectral index of the emissivity law for the graybody
+	'''
+	Trf, Lrf, zin = np.broadcast_arrays(np.ravel(Trf), np.ravel(Lrf), np.ravel(zin))
+	Tobs = Trf / (1. + zin)
+
+	Lir = Lrf / luminosity_conversion(zin) # Jy x Hz
+
+	if table != None:
+		integral = table.integral(Tobs, b, alphain)
+	else:
+		integral = unit_sed_integral(Tobs, b, alphain)
+
+	return Lir / integral
+
+class AmplitudeTable:
+
+	def __init__(self, betas = [2.0], alphain = 2.0, T_min = 0.5, T_max = 200.0, nT = 2000):
+		'''
+		unit_sed_integral tabulated over (beta, Tobs = Trf/(1+z)), with Tobs uniform in log,
+		for amplitude_from_greybody.  integral() interpolates linearly in log-log;
+		the worst relative error, at the grid midpoints, is stored in max_error.
+		'''
+		self.betas = np.ravel(np.asarray(betas, dtype=np.float64))
+		self.alphain = alphain
+		self.logT = np.linspace(np.log(T_min), np.log(T_max), nT)
+		self.log_integrals = np.zeros([len(self.betas), nT])
+		self.max_error = 0.0
+		logT_mid = 0.5 * (self.logT[1:] + self.logT[:-1])
+		for ib in range(len(self.betas)):
+			self.log_integrals[ib] = np.log(unit_sed_integral(np.exp(self.logT), self.betas[ib], alphain))
+			exact = unit_sed_integral(np.exp(logT_mid), self.betas[ib], alphain)
+			interp = np.exp(0.5 * (self.log_integrals[ib,1:] + self.log_integrals[ib,:-1]))
+			self.max_error = max(self.max_error, np.max(np.abs(interp / exact - 1.0)))
+
+	def integral(self, Tobs, betain = 2.0, alphain = None):
+		if alphain != None and not np.isclose(alphain, self.alphain):
+			raise ValueError("alpha={} does not match the amplitude table alpha={}".format(alphain, self.alphain))
+		ib = np.where(np.isclose(self.betas, betain))[0]
+		if len(ib) == 0:
+			raise ValueError("beta={} is not in the amplitude table {}".format(betain, self.betas))
+		logT = np.log(Tobs)
+		if np.any((logT < self.logT[0]) | (logT > self.logT[-1])):
+			raise ValueError("Tobs outside the amplitude table range [{}, {}]".format(np.exp(self.logT[0]), np.exp(self.logT[-1])))
+		return np.exp(np.interp(logT, self.logT, self.log_integrals[ib[0]]))
 
 def invert_sed_neural_net(lam, Trf, Lrf, zin, wpath = '/data/pickles/simstack/ann_function_fits/', wfile = 'SED_amplitude_weights_from_neural_network_logistic_100layers_N8000.p'):
 
@@ -351,3 +348,78 @@ def invert_sed_neural_net(lam, Trf, Lrf, zin, wpath = '/data/pickles/simstack/an
 
 	fluxes = sed_direct(predicted_amplitude, np.array([nuvector]), Trf/(1.+zin), betain=2.0, alphain=2.0)
 	return fluxes
+
+def invert_sed_exact(lam, Trf, Lrf, zin, betain = 2.0, alphain = 2.0, table = None):
+	'''
+	Drop-in for invert_sed_neural_net: fluxes (mJy) at wavelengths lam for arrays of (Trf, Lrf, zin),
+	with exact amplitudes from amplitude_from_greybody instead of a pickled regressor.
+	'''
+	nuvector = c * 1.e6 / np.asarray(lam)
+
+	amplitude = amplitude_from_greybody(Trf, Lrf, zin, b = betain, alphain = alphain, table = table)
+
+	fluxes = sed_direct(amplitude, np.array([nuvector]), np.ravel(Trf)/(1.+np.ravel(zin)), betain=betain, alphain=alphain)
+	return fluxes
+
+def catalog_flux_chunk(args):
+	'''
+	Fluxes for one chunk of fluxes_from_catalog; a top-level function so it can run on a Pool
+	'''
+	nuvector, zin, Trf, Lrf, b, alphain, table = args
+	amplitude = np.zeros(len(zin))
+	for beta in np.unique(b):
+		ind = np.where(b == beta)[0]
+		amplitude[ind] = amplitude_from_greybody(Trf[ind], Lrf[ind], zin[ind], b = beta, alphain = alphain, table = table)
+	return sed_direct(amplitude, nuvector, Trf/(1.+zin), b[:,None], alphain)
+
+def fluxes_from_catalog(lambdavector, zin, Trf, Lrf, b = 2.0, alphain = 2.0, chunk_size = 100000, nproc = 1, table = None, out = None):
+	'''
+	Observed flux densities (mJy), [ngal, nbands], for whole catalogs of greybody galaxies.
+	Equivalent to single_simple_flux_from_greybody per galaxy, but amplitudes come from
+	amplitude_from_greybody with an AmplitudeTable (built over the catalog's Tobs range and
+	betas unless one is passed), and the catalog is streamed chunk_size galaxies at a time,
+	so inputs may be memory-mapped and memory stays bounded.  With nproc > 1 chunks are
+	evaluated on a process pool.  out can be an [ngal, nbands] array, or a filename to write
+	a .npy memmap; otherwise a new array is returned.
+
+	Inputs:
+	lambdavector = array of wavelengths of interest [in microns]
+	zin, Trf, Lrf = catalog arrays of redshift, rest-frame temperature [K] and L_IR [L_sun]
+	b = emissivity index, scalar or per-galaxy array
+	'''
+	ngal = len(zin)
+	nuvector = c * 1.e6 / np.asarray(lambdavector) # Hz
+	b_all = np.broadcast_to(np.asarray(b, dtype=float), (ngal,))
+
+	if table == None:
+		Tobs_min = np.inf
+		Tobs_max = 0.0
+		betas = set()
+		for i in range(0, ngal, chunk_size):
+			Tobs = np.asarray(Trf[i:i+chunk_size]) / (1. + np.asarray(zin[i:i+chunk_size]))
+			Tobs_min = min(Tobs_min, np.min(Tobs))
+			Tobs_max = max(Tobs_max, np.max(Tobs))
+			betas.update(np.unique(b_all[i:i+chunk_size]))
+		table = AmplitudeTable(betas = sorted(betas), alphain = alphain, T_min = 0.9 * Tobs_min, T_max = 1.1 * Tobs_max)
+
+	if out is None:
+		out = np.zeros([ngal, len(nuvector)])
+	elif isinstance(out, str):
+		out = np.lib.format.open_memmap(out, mode = 'w+', dtype = np.float64, shape = (ngal, len(nuvector)))
+
+	chunks = ((nuvector, np.asarray(zin[i:i+chunk_size]), np.asarray(Trf[i:i+chunk_size]), np.asarray(Lrf[i:i+chunk_size]),
+		np.asarray(b_all[i:i+chunk_size]), alphain, table) for i in range(0, ngal, chunk_size))
+
+	if nproc > 1:
+		pool = Pool(nproc)
+		try:
+			for i, fluxes in izip(xrange(0, ngal, chunk_size), pool.imap(catalog_flux_chunk, chunks)):
+				out[i:i+chunk_size] = fluxes
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for i, args in izip(xrange(0, ngal, chunk_size), chunks):
+			out[i:i+chunk_size] = catalog_flux_chunk(args)
+
+	return out
@@ -1,5 +1,7 @@
 import pdb
 import numpy as np
+from numpy.polynomial.polynomial import polygrid2d
+from numpy.polynomial.polynomial import polyvander
 from astropy.wcs import WCS
 from utils import circle_mask
 from utils import dist_idl
@@ -9,42 +11,87 @@ from utils import shift_twod
 from utils import smooth_psf
 from lmfit import Parameters, minimize, fit_report
 
-def L_vs_z_m_polynomial_fn(p, zz, mm):
+def polynomial_coefficients(p):
+	''' A{i}{j} of p as a [degreeA, degreeB] array, i the power of z and j the power of m '''
 	v = p.valuesdict()
-	degreeA = v['degreeA']
-	degreeB = v['degreeB']
-	nm = len(mm)
-	nz = len(zz)
-
-	B = np.zeros([degreeA, nm])
-	for j in range(degreeB):  #Offset, slope, (2nd order)
-		for i in range(degreeA): #Fit to fluxes
-			B[i,:] += v[str('A'+str(i)+str(j))] * mm ** j
-
-	Lout = np.zeros([nz,nm])
-	for k in range(nm):
-		yk = np.zeros(nz)
-		for i in range(degreeA):
-			yk += B[i,k] * zz ** i
-		Lout[:,k] = yk
+	degreeA = int(v['degreeA'])
+	degreeB = int(v['degreeB'])
+	coefficients = np.zeros([degreeA, degreeB])
+	for i in range(degreeA):
+		for j in range(degreeB):
+			coefficients[i,j] = v[str('A'+str(i)+str(j))]
+	return coefficients
 
-	return Lout 
+def L_vs_z_m_polygrid(coefficients, zz, mm):
+	''' Surface sum A_ij z^i m^j on the (zz, mm) grid, [nz, nm] '''
+	return polygrid2d(np.asarray(zz, dtype=float), np.asarray(mm, dtype=float), coefficients)
 
-def L_vs_z_m_polynomial_fit(p, zz, mm, L, L_err = None, lam_reg = 0.0):
+def L_vs_z_m_polynomial_fn(p, zz, mm):
+	return L_vs_z_m_polygrid(polynomial_coefficients(p), zz, mm)
 
-	v = p.valuesdict()
-	degreeA = v['degreeA']
-	degreeB = v['degreeB']
-	nm = len(mm)
-	nz = len(zz)
+def L_vs_z_m_polynomial_fit(p, zz, mm, L, L_err = None, lam_reg = 0.0):
 
-	B = np.zeros([degreeA, nm])
-	for j in range(degreeB):  #Offset, slope, (2nd order)
-		for i in range(degreeA): #Fit to fluxes
-			B[i,:] += v[str('A'+str(i)+str(j))] * mm ** j
+	coefficients = polynomial_coefficients(p)
+	B = np.dot(coefficients, polyvander(np.asarray(mm, dtype=float), np.shape(coefficients)[1] - 1).T)
 
-	Lout = L_vs_z_m_polynomial_fn(p, zz, mm)
+	Lout = L_vs_z_m_polygrid(coefficients, zz, mm)
 
 	return (Lout - L) / L_err + lam_reg / 2.0 / len(L) * np.sum(B ** 2.)
 
+def L_vs_z_m_ridge_factor(zz, mm, L, L_err = None, degreeA = 3, degreeB = 2):
+	'''
+	Factorize the weighted, regularized least-squares problem for the A{i}{j} surface once:
+	minimize sum ((Lout - L) / L_err)^2 + lam_reg * sum B^2, with B[i,k] = sum_j A_ij mm_k^j
+	the penalty on the mass polynomials that L_vs_z_m_polynomial_fit uses.  The penalty is
+	sum_i a_i^T (Vm^T Vm) a_i, so with Vm^T Vm = R^T R the problem becomes a standard ridge in
+	R a_i, solved for any lam_reg from one SVD (L_vs_z_m_ridge_solve).
+	Non-finite L or L_err entries get zero weight.
+	'''
+	zz = np.asarray(zz, dtype=float)
+	mm = np.asarray(mm, dtype=float)
+	L = np.asarray(L, dtype=float)
+	if L_err is None:
+		L_err = np.ones(np.shape(L))
+	L_err = np.asarray(L_err, dtype=float)
+
+	good = np.isfinite(L) & np.isfinite(L_err) & (L_err > 0)
+	weights = np.zeros(np.shape(L))
+	weights[good] = 1.0 / L_err[good]
+
+	Vz = polyvander(zz, degreeA - 1)
+	Vm = polyvander(mm, degreeB - 1)
+	R_inv = np.linalg.inv(np.linalg.cholesky(np.dot(Vm.T, Vm)).T)
+	design = np.kron(Vz, np.dot(Vm, R_inv)) * np.ravel(weights)[:,None]
+	U, S, Vt = np.linalg.svd(design, full_matrices = False)
+	Uty = np.dot(U.T, np.where(good, L, 0.0).ravel() * np.ravel(weights))
+
+	return {'degreeA':degreeA, 'degreeB':degreeB, 'R_inv':R_inv, 'S':S, 'Vt':Vt, 'Uty':Uty}
+
+def L_vs_z_m_ridge_solve(factor, lam_reg = 0.0):
+	''' Coefficients [degreeA, degreeB] for one lam_reg from L_vs_z_m_ridge_factor '''
+	S = factor['S']
+	b = np.dot(factor['Vt'].T, S / (S**2 + lam_reg) * factor['Uty'])
+	return np.dot(np.reshape(b, (factor['degreeA'], factor['degreeB'])), factor['R_inv'].T)
+
+def L_vs_z_m_ridge_fit(zz, mm, L, L_err = None, degreeA = 3, degreeB = 2, lam_reg = 0.0):
+	'''
+	Direct (no lmfit) fit of the L(z, M) polynomial surface; see L_vs_z_m_ridge_factor.
+	Returns Parameters with degreeA, degreeB and A{i}{j}, as used by L_vs_z_m_polynomial_fn,
+	or a list of them when lam_reg is a sequence (one factorization shared by all).
+	'''
+	factor = L_vs_z_m_ridge_factor(zz, mm, L, L_err, degreeA, degreeB)
+
+	fits = []
+	for lam in np.atleast_1d(lam_reg):
+		coefficients = L_vs_z_m_ridge_solve(factor, lam)
+		p = Parameters()
+		p.add('degreeA', value = degreeA, vary = False)
+		p.add('degreeB', value = degreeB, vary = False)
+		for i in range(degreeA):
+			for j in range(degreeB):
+				p.add(str('A'+str(i)+str(j)), value = coefficients[i,j])
+		fits.append(p)
 
+	if np.ndim(lam_reg) == 0:
+		return fits[0]
+	return fits
@@ -1,9 +1,13 @@
 import pdb
 import gc
+import itertools
 import numpy as np
+import pandas as pd
 from numpy import zeros
 from numpy import shape
 import cPickle as pickle
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 #from astropy.cosmology import FlatLambdaCDM
 from astropy.cosmology import Planck15 as cosmo
 import astropy.units as u
@@ -16,6 +20,7 @@ from utils import clean_nans
 from utils import clean_args
 from utils import completeness_flag_neural_net
 from utils import subset_averages_from_ids
+from utils import conv_lir_to_sfr
 
 pi = 3.141592653589793
 L_sun = 3.839e26 # W
@@ -23,6 +28,9 @@ c = 299792458.0 # m/s
 conv_sfr=1.728e-10/10 ** (.23)
 gc.enable()
 
+resampling_shared = {}
+selection_shared = {}
+
 def fast_variable_power_law_wrapper(feature_dict_in, redshifts=None, Y_array=None, covar=None):
     additional_features = {}
     feature_dict = feature_dict_in.copy()
@@ -92,6 +100,87 @@ def build_training_set(db,stacked_flux_densities, features_list, znodes, mnodes,
 
     return training_set
 
+def fast_build_training_set(db,stacked_flux_densities, features_list, znodes, mnodes, knodes, Y_dict=None, k_init = 0, k_final = None, cc=0.5, ngal_cut=10, use_median=False):
+    ''' Same output as build_training_set, without the per-bin full-table scans:
+    every (bin, ID) pair is joined to the catalog once, all features are averaged with one
+    grouped aggregation (NaN/inf counted as 0 and -99.9 excluded, as in subset_averages_from_ids),
+    and completeness is predicted for all bin centres of a population in one call.
+    '''
+    nz = len(znodes)-1
+    nm = len(mnodes)-1
+    nk = len(knodes)
+    if k_final == None:
+        k_final = len(knodes)+1
+    training_set = {}
+    if Y_dict != None:
+        keys = [i for i in Y_dict.keys()]
+        key = keys[keys != 'Y_err']
+        training_set[key] = []
+        training_set['Y_err'] = []
+    for ft in features_list:
+        if ft in ['LMASS','lmass']:
+            training_set['stellar_mass'] = []
+        else:
+            training_set[ft] = []
+
+    #Bins in build_training_set order, with their centres for the completeness model
+    args = []
+    pops = []
+    zcens = []
+    mcens = []
+    for k in range(nk)[k_init:k_final]:
+        for im in range(nm):
+            mn = mnodes[im:im+2]
+            m_suf = '{:.2f}'.format(mn[0])+'-'+'{:.2f}'.format(mn[1])
+            for iz in range(nz):
+                zn = znodes[iz:iz+2]
+                z_suf = '{:.2f}'.format(zn[0])+'-'+'{:.2f}'.format(zn[1])
+                args.append(clean_args('z_'+z_suf+'__m_'+m_suf+'_'+knodes[k]))
+                pops.append(k)
+                zcens.append(np.mean(zn))
+                mcens.append(np.mean(mn))
+    pops = np.array(pops)
+
+    completeness_flags = np.zeros(len(args), dtype=bool)
+    for k in np.unique(pops):
+        ind = np.where(pops == k)[0]
+        completeness_flags[ind] = completeness_flag_neural_net(np.array(zcens)[ind],np.array(mcens)[ind],sfg=k, completeness_cut = cc)
+
+    ngals = np.array([len(stacked_flux_densities.bin_ids[arg]) for arg in args])
+
+    pairs = pd.DataFrame({'bin': np.repeat(np.arange(len(args)), ngals),
+        'ID': np.concatenate([np.ravel(stacked_flux_densities.bin_ids[arg]) for arg in args] + [np.array([], dtype=db.table.ID.dtype)])})
+    pairs = pairs.drop_duplicates()
+    values = db.table[['ID'] + list(features_list)]
+    members = pairs.merge(values, on='ID', how='inner')
+    features = members[list(features_list)].replace([np.inf, -np.inf], np.nan).fillna(0.0)
+    features = features.where(features != -99.9)
+    features['bin'] = members['bin'].values
+    grouped = features.groupby('bin')
+    if use_median:
+        averages = grouped.median()
+    else:
+        averages = grouped.mean()
+    averages = averages.reindex(np.arange(len(args)))
+
+    for i, arg in enumerate(args):
+        if ((ngals[i] > ngal_cut) & (completeness_flags[i] == True)):
+            if Y_dict != None:
+                try:
+                    training_set[key].append(Y_dict[key][arg][0])
+                except IndexError:
+                    training_set[key].append(Y_dict[key][arg])
+                training_set['Y_err'].append(Y_dict['Y_err'][arg])
+            for ft in features_list:
+                if ft in['ltau','lage','a_hat_AGN','la2t']:
+                    training_set[ft].append(10**averages[ft].values[i])
+                elif ft in['LMASS','lmass']:
+                    training_set['stellar_mass'].append(10**averages[ft].values[i])
+                else:
+                    training_set[ft].append(averages[ft].values[i])
+
+    return training_set
+
 def fit_simple_power_law(p, redshifts, lir, feature1=None, feature2=None, feature3=None,  feature4=None, feature5=None, covar = None):
     v = p.valuesdict()
     A= np.asarray(v['L0'])
@@ -250,6 +339,344 @@ def fast_variable_power_law_fitter0(redshifts, lir, additional_features = {}, co
 
     return m
 
+def power_law_design_matrix(redshifts, additional_features = {}):
+    ''' Stack the logs once: columns 1, log z, and log f, log f * log z per feature,
+    named L0, gm_z, gm_<feature>, gm_z_<feature> as in fast_variable_power_law_fitter.
+    additional_features values are arrays or the {name: array} dicts the older fitters take.
+    Returns (names, X).
+    '''
+    logz = np.log10(np.ndarray.flatten(np.array(redshifts, dtype=float)))
+    names = ['L0', 'gm_z']
+    columns = [np.ones(len(logz)), logz]
+    for i in additional_features:
+        feature = additional_features[i]
+        if isinstance(feature, dict):
+            feature = feature.values()[0]
+        logf = np.log10(np.ndarray.flatten(np.array(feature, dtype=float)))
+        names += ['gm_'+i, 'gm_z_'+i]
+        columns += [logf, logf * logz]
+    return names, np.array(columns).T
+
+def select_design_columns(design, features):
+    ''' (names, X) restricted to L0, gm_z and the columns of the given features '''
+    names, X = design
+    keep = [j for j, name in enumerate(names) if name in ['L0', 'gm_z'] or
+        any(name in ['gm_'+i, 'gm_z_'+i] for i in features)]
+    return [names[j] for j in keep], X[:,keep]
+
+def design_power_law_model(p, names, X):
+    v = p.valuesdict()
+    powerlaw = np.dot(X, np.array([v[name] for name in names]))
+    return clean_nans(powerlaw)
+
+def fit_design_power_law(p, names, X, lir, covar = None):
+    ''' Residuals of the power law log L = X theta.  Rows with a non-positive or non-finite
+    power law, which find_variable_power_law_fit drops, are returned as zeros so the
+    residual keeps a fixed length.
+    '''
+    powerlaw = design_power_law_model(p, names, X)
+    resid = np.where(powerlaw > 0, lir - 10**powerlaw, 0.0)
+    if covar is None:
+        return resid
+    else:
+        return resid / covar
+
+def fit_design_power_law_jacobian(p, names, X, lir, covar = None):
+    ''' Analytic Jacobian of fit_design_power_law, one column per varying parameter in Parameters order '''
+    powerlaw = design_power_law_model(p, names, X)
+    dresid = np.where(powerlaw > 0, -np.log(10.) * 10**powerlaw, 0.0)
+    if covar is not None:
+        dresid = dresid / covar
+    cols = [names.index(name) for name in p if p[name].vary and p[name].expr == None]
+    return dresid[:,None] * X[:,cols]
+
+def design_power_law_fitter(redshifts, lir, additional_features = {}, covar = None, evolving_slope = True, design = None, start_params = None):
+    ''' fast_variable_power_law_fitter for any number of features, with the residual as one
+    matrix-vector product and an analytic Jacobian.  Pass design = (names, X) from
+    power_law_design_matrix (or select_design_columns) to reuse the logs across fits;
+    redshifts and additional_features are then ignored.  Parameter names match
+    fast_variable_power_law_fitter, so assign_weights_cat_names works on the result.
+    start_params = Parameters (e.g. a previous fit's) to warm-start from instead of the defaults.
+    '''
+    if design is None:
+        design = power_law_design_matrix(redshifts, additional_features)
+    names, X = design
+    lir = np.ndarray.flatten(np.array(lir, dtype=float))
+    if covar is not None:
+        covar = np.ndarray.flatten(np.array(covar, dtype=float))
+
+    if start_params != None:
+        fit_params = start_params.copy()
+    else:
+        fit_params = Parameters()
+        fit_params.add('L0', value = 9.5)
+        fit_params.add('gm_z', value = 1.8, vary = True)
+        for j in range(2, len(names), 2):
+            fit_params.add(names[j+1], value = 0.0, vary = evolving_slope)
+            fit_params.add(names[j], value = 0.1, vary = True)
+
+    m = minimize(fit_design_power_law, fit_params,
+        args = (names, X, lir),
+        kws = {'covar': covar},
+        Dfun = fit_design_power_law_jacobian)
+
+    return m
+
+def resampling_initializer(X, shape, lir, covar, names, start_params):
+    ''' Pool initializer for power_law_resampling: keep views of the shared training set '''
+    resampling_shared['X'] = np.frombuffer(X).reshape(shape)
+    resampling_shared['lir'] = np.frombuffer(lir)
+    if covar != None:
+        resampling_shared['covar'] = np.frombuffer(covar)
+    else:
+        resampling_shared['covar'] = None
+    resampling_shared['names'] = names
+    resampling_shared['start_params'] = start_params
+
+def resampling_fit(ind):
+    ''' Refit one resample (row indices into the shared training set), warm-started from the full fit '''
+    X = resampling_shared['X']
+    covar = resampling_shared['covar']
+    if covar is not None:
+        covar = covar[ind]
+    start_params = resampling_shared['start_params']
+    m = design_power_law_fitter(None, resampling_shared['lir'][ind], covar = covar,
+        design = (resampling_shared['names'], X[ind]), start_params = start_params)
+    return np.array([m.params[name].value for name in start_params])
+
+def power_law_resampling(redshifts, lir, additional_features = {}, covar = None, method = 'bootstrap', nsamples = 1000, evolving_slope = True, nproc = 1, seed = None, q = [16, 50, 84]):
+    ''' Parameter distributions of design_power_law_fitter from bootstrap (nsamples resamples
+    with replacement) or jackknife (leave-one-out, one per row) refits of the training set.
+    Every refit starts from the full-sample solution.  With nproc > 1 the refits run on a process
+    pool whose workers read the design matrix, lir and covar from shared memory.
+    Returns a dict with the full fit, parameter names, samples [nsamples, nparams],
+    percentiles q [len(q), nparams] and std (jackknife-scaled for method = 'jackknife').
+    '''
+    names, X = power_law_design_matrix(redshifts, additional_features)
+    lir = np.ndarray.flatten(np.array(lir, dtype=float))
+    if covar is not None:
+        covar = np.ndarray.flatten(np.array(covar, dtype=float))
+    full = design_power_law_fitter(None, lir, covar = covar, evolving_slope = evolving_slope, design = (names, X))
+
+    ndata = len(lir)
+    if method == 'bootstrap':
+        random = np.random.RandomState(seed)
+        resamples = [random.randint(ndata, size = ndata) for i in range(nsamples)]
+    elif method == 'jackknife':
+        resamples = [np.delete(np.arange(ndata), i) for i in range(ndata)]
+    else:
+        raise ValueError("method must be 'bootstrap' or 'jackknife', got {}".format(method))
+
+    shared_X = RawArray('d', X.size)
+    np.frombuffer(shared_X)[:] = np.ravel(X)
+    shared_lir = RawArray('d', ndata)
+    np.frombuffer(shared_lir)[:] = lir
+    shared_covar = None
+    if covar is not None:
+        shared_covar = RawArray('d', ndata)
+        np.frombuffer(shared_covar)[:] = covar
+    initargs = (shared_X, np.shape(X), shared_lir, shared_covar, names, full.params)
+
+    if nproc > 1:
+        pool = Pool(nproc, initializer = resampling_initializer, initargs = initargs)
+        try:
+            samples = pool.map(resampling_fit, resamples, chunksize = max(1, len(resamples) // (4 * nproc)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        resampling_initializer(*initargs)
+        samples = [resampling_fit(ind) for ind in resamples]
+    samples = np.array(samples)
+
+    if method == 'jackknife':
+        std = np.sqrt((ndata - 1.0) / ndata * np.sum((samples - np.mean(samples, axis=0))**2, axis=0))
+    else:
+        std = np.std(samples, axis=0)
+
+    return {'fit': full, 'names': list(full.params.keys()), 'samples': samples,
+        'percentiles': np.percentile(samples, q, axis=0), 'std': std}
+
+def selection_initializer(design, lir, covar, folds, evolving_slope):
+    ''' Pool initializer for power_law_feature_selection: the cached design matrix and folds '''
+    selection_shared['design'] = design
+    selection_shared['lir'] = lir
+    selection_shared['covar'] = covar
+    selection_shared['folds'] = folds
+    selection_shared['evolving_slope'] = evolving_slope
+
+def cv_score(features):
+    ''' k-fold CV error (mean squared normalized residual of held-out rows) of one feature subset '''
+    names, X = select_design_columns(selection_shared['design'], features)
+    lir = selection_shared['lir']
+    covar = selection_shared['covar']
+    folds = selection_shared['folds']
+    errors = []
+    for k in range(len(folds)):
+        test = folds[k]
+        train = np.concatenate([folds[i] for i in range(len(folds)) if i != k])
+        m = design_power_law_fitter(None, lir[train], covar = covar[train], design = (names, X[train]),
+            evolving_slope = selection_shared['evolving_slope'])
+        resid = fit_design_power_law(m.params, names, X[test], lir[test], covar = covar[test])
+        errors.append(np.mean(resid**2))
+    return np.mean(errors), np.std(errors)
+
+def power_law_feature_selection(feature_dict_in, candidates = None, method = 'exhaustive', nfolds = 5, max_features = None, evolving_slope = True, nproc = 1, seed = None):
+    ''' Rank feature subsets for fast_variable_power_law_wrapper by k-fold cross-validation.
+    feature_dict_in is in the wrapper format (z_peak, Y_val, Y_err and one array per feature).
+    method = 'exhaustive' scores every subset of candidates up to max_features;
+    'forward' / 'backward' follow the greedy path adding / removing the feature that most
+    lowers the CV error.  Logs (power_law_design_matrix) and folds are computed once, and with
+    nproc > 1 candidate subsets are scored on a process pool.
+    Returns a pandas DataFrame sorted by cv_error, with the subset, its CV error and the
+    assign_weights_cat_names weights of the fit to the full training set.
+    '''
+    feature_dict = feature_dict_in.copy()
+    redshifts = feature_dict.pop('z_peak')
+    lir = np.ndarray.flatten(np.array(feature_dict.pop('Y_val'), dtype=float))
+    covar = np.ndarray.flatten(np.array(feature_dict.pop('Y_err'), dtype=float))
+    if candidates == None:
+        candidates = sorted(feature_dict.keys())
+    if max_features == None:
+        max_features = len(candidates)
+    design = power_law_design_matrix(redshifts, dict((i, feature_dict[i]) for i in candidates))
+
+    random = np.random.RandomState(seed)
+    folds = np.array_split(random.permutation(len(lir)), nfolds)
+
+    if method not in ['exhaustive', 'forward', 'backward']:
+        raise ValueError("method must be 'exhaustive', 'forward' or 'backward', got {}".format(method))
+
+    initargs = (design, lir, covar, folds, evolving_slope)
+    if nproc > 1:
+        pool = Pool(nproc, initializer = selection_initializer, initargs = initargs)
+        score = lambda subsets: pool.map(cv_score, subsets)
+    else:
+        selection_initializer(*initargs)
+        score = lambda subsets: [cv_score(subset) for subset in subsets]
+
+    scores = {}
+    try:
+        if method == 'exhaustive':
+            subsets = [subset for n in range(max_features + 1) for subset in itertools.combinations(candidates, n)]
+            scores.update(zip(subsets, score(subsets)))
+        else:
+            current = () if method == 'forward' else tuple(candidates)
+            scores.update(zip([current], score([current])))
+            while True:
+                if method == 'forward':
+                    if len(current) >= max_features:
+                        break
+                    steps = [current + (i,) for i in candidates if i not in current]
+                else:
+                    steps = [tuple(i for i in current if i != j) for j in current]
+                if len(steps) == 0:
+                    break
+                results = score(steps)
+                scores.update(zip(steps, results))
+                best = np.argmin([result[0] for result in results])
+                if results[best][0] >= scores[current][0]:
+                    break
+                current = steps[best]
+    finally:
+        if nproc > 1:
+            pool.close()
+            pool.join()
+
+    rows = []
+    for subset in scores:
+        m = design_power_law_fitter(None, lir, covar = covar, design = select_design_columns(design, subset), evolving_slope = evolving_slope)
+        row = {'features': subset, 'nfeatures': len(subset), 'cv_error': scores[subset][0], 'cv_error_std': scores[subset][1]}
+        row.update(assign_weights_cat_names(m))
+        rows.append(row)
+
+    table = pd.DataFrame(rows).sort_values('cv_error').reset_index(drop = True)
+    columns = ['features', 'nfeatures', 'cv_error', 'cv_error_std']
+    return table[columns + sorted(c for c in table.columns if c not in columns)]
+
+def compile_power_law(fn):
+    ''' Coefficient vector of a fitted power law (fast_variable_power_law_fitter or
+    design_power_law_fitter), read from fn.params once.  Returns (terms, theta) where each term
+    is (feature, evolving): log10 L_IR = sum theta * log f [* log z], with feature None for the
+    constant and 'z' for log z itself.
+    '''
+    terms = []
+    theta = []
+    for name in fn.params:
+        if name == 'L0':
+            terms.append((None, False))
+        elif name == 'gm_z':
+            terms.append(('z', False))
+        elif name.startswith('gm_z_'):
+            terms.append((name[5:], True))
+        elif name.startswith('gm_'):
+            terms.append((name[3:], False))
+        else:
+            continue
+        theta.append(fn.params[name].value)
+    return terms, np.array(theta)
+
+def catalog_log_features(chunk, features, z_col = 'z_peak', mass_col = 'LMASS'):
+    ''' log10 of the training-set features from catalog columns: ltau, lage, a_hat_AGN and la2t
+    are stored as logs and stellar_mass comes from mass_col, as in build_training_set.
+    '''
+    logs = {'z': np.log10(np.asarray(chunk[z_col], dtype=float))}
+    for ft in features:
+        if ft in ['z', None] or ft in logs:
+            continue
+        if ft in ['ltau','lage','a_hat_AGN','la2t']:
+            logs[ft] = np.asarray(chunk[ft], dtype=float)
+        elif ft == 'stellar_mass':
+            logs[ft] = np.asarray(chunk[mass_col], dtype=float)
+        else:
+            logs[ft] = np.log10(np.asarray(chunk[ft], dtype=float))
+    return logs
+
+def predict_power_law_chunk(terms, theta, chunk, z_col = 'z_peak', mass_col = 'LMASS'):
+    logs = catalog_log_features(chunk, [ft for ft, evolving in terms], z_col = z_col, mass_col = mass_col)
+    log_lir = np.zeros(len(logs['z']))
+    for (ft, evolving), coefficient in zip(terms, theta):
+        column = 1.0 if ft == None else logs[ft]
+        if evolving:
+            column = column * logs['z']
+        log_lir += coefficient * column
+    return log_lir
+
+def predict_catalog_power_law(fn, catalog, out, chunk_size = 100000, z_col = 'z_peak', mass_col = 'LMASS', id_col = 'ID'):
+    ''' Apply a fitted power law to a large catalog in chunks of chunk_size rows.
+    The model is compiled once (compile_power_law), including any z-evolving slopes.
+    catalog is a CSV filename, streamed with pandas, or a structured (e.g. memory-mapped .npy)
+    array.  Predicted log10 L_IR and SFR = conv_lir_to_sfr * L_IR are written to out:
+    a CSV (with id_col, when the catalog has it) for CSV input, otherwise a .npy memmap
+    with fields log_LIR and SFR.  Returns out.
+    '''
+    terms, theta = compile_power_law(fn)
+    columns = set([z_col] + [mass_col if ft == 'stellar_mass' else ft for ft, evolving in terms if ft not in [None, 'z']])
+
+    if isinstance(catalog, str):
+        header = pd.read_csv(catalog, nrows = 0).columns
+        if id_col in header:
+            columns.add(id_col)
+        first = True
+        for chunk in pd.read_csv(catalog, usecols = list(columns), chunksize = chunk_size):
+            log_lir = predict_power_law_chunk(terms, theta, chunk, z_col = z_col, mass_col = mass_col)
+            predicted = pd.DataFrame({'log_LIR': log_lir, 'SFR': conv_lir_to_sfr * 10**log_lir}, columns = ['log_LIR', 'SFR'])
+            if id_col in header:
+                predicted.insert(0, id_col, chunk[id_col].values)
+            predicted.to_csv(out, mode = 'w' if first else 'a', header = first, index = False)
+            first = False
+    else:
+        ngal = len(catalog)
+        predicted = np.lib.format.open_memmap(out, mode = 'w+', dtype = [('log_LIR', np.float64), ('SFR', np.float64)], shape = (ngal,))
+        for i in range(0, ngal, chunk_size):
+            log_lir = predict_power_law_chunk(terms, theta, catalog[i:i+chunk_size], z_col = z_col, mass_col = mass_col)
+            predicted['log_LIR'][i:i+chunk_size] = log_lir
+            predicted['SFR'][i:i+chunk_size] = conv_lir_to_sfr * 10**log_lir
+        predicted.flush()
+        del predicted
+
+    return out
+
 def assign_weights(fn,silent=True):
     if silent == False:
         #print fn.var_names
@@ -0,0 +1,194 @@
+import os
+import numpy as np
+from utils import greybody_kernel
+from utils import fast_sed_batch_fitter
+
+c = 299792458.0 # m/s
+
+class SedSampler:
+
+    def __init__(self, wavelengths, fluxes, covar, betain=1.8, alphain=2.0, nwalkers=32,
+        T_range=[1.0, 150.0], log10A_range=[-60.0, -20.0], a=2.0, template=None, seed=None):
+        ''' Affine-invariant (Goodman & Weare stretch move) ensemble sampler for the fast_sed
+        parameters [log10 A, T_observed] of n_bins stacked SEDs at once.
+        fluxes is [n_bins, n_wavelengths]; covar is either the matching 1-sigma errors or full
+        covariance matrices, as in fast_sed_batch_fitter.  Priors are uniform within T_range
+        and log10A_range.  Every half-step evaluates all bins x walkers in a single
+        greybody_kernel call (or template.sed for a sed_templates.SedTemplateGrid).
+        '''
+        self.wavelengths = np.ravel(np.asarray(wavelengths, dtype=float))
+        self.nu_in = c * 1.e6 / self.wavelengths
+        self.fluxes = np.atleast_2d(fluxes)
+        self.nb, self.nw = np.shape(self.fluxes)
+        self.covar = np.asarray(covar, dtype=float)
+        if self.covar.ndim == 3:
+            self.precision = np.linalg.inv(self.covar)
+        else:
+            self.weights = 1.0 / np.reshape(self.covar, (self.nb, self.nw))**2
+        self.betain = betain
+        self.alphain = alphain
+        if nwalkers % 2 or nwalkers < 4:
+            raise ValueError("nwalkers must be even and at least 4, got {}".format(nwalkers))
+        self.nwalkers = nwalkers
+        self.ndim = 2
+        self.T_range = T_range
+        self.log10A_range = log10A_range
+        self.a = a
+        self.template = template
+        self.random = np.random.RandomState(seed)
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.lnprob = None
+        self.chain = np.zeros([self.nb, self.nwalkers, 0, self.ndim])
+        self.lnprobability = np.zeros([self.nb, self.nwalkers, 0])
+        self.naccepted = np.zeros([self.nb, self.nwalkers])
+        self.iterations = 0
+
+    def log_prob(self, theta):
+        ''' Log posterior of theta [n_bins, k, 2] -> [n_bins, k] '''
+        log10A = np.ravel(theta[:,:,0])
+        T = np.ravel(theta[:,:,1])
+        k = np.shape(theta)[1]
+        inside = ((T > self.T_range[0]) & (T < self.T_range[1]) &
+            (log10A > self.log10A_range[0]) & (log10A < self.log10A_range[1]))
+
+        lnp = np.empty(len(T))
+        lnp.fill(-np.inf)
+        ind = np.where(inside)[0]
+        if len(ind) == 0:
+            return np.reshape(lnp, (self.nb, k))
+
+        if self.template != None:
+            model = self.template.sed(10**log10A[ind], T[ind], self.wavelengths, self.betain, self.alphain)
+        else:
+            model = greybody_kernel(10**log10A[ind], T[ind], self.nu_in, self.betain, self.alphain)
+
+        ib = ind // k
+        r = self.fluxes[ib] - model
+        if self.covar.ndim == 3:
+            chi2 = np.einsum('gi,gij,gj->g', r, self.precision[ib], r)
+        else:
+            chi2 = np.sum(self.weights[ib] * r**2, axis=1)
+        lnp[ind] = -0.5 * chi2
+
+        return np.reshape(lnp, (self.nb, k))
+
+    def initialize(self, p0=None, scatter=1e-2):
+        ''' Starting walkers [n_bins, nwalkers, 2].  Without p0, a small ball around the
+        fast_sed_batch_fitter solution of each bin, scaled by its errors (see start_amplitudes
+        for bins fitted with A <= 0).
+        '''
+        if p0 is None:
+            fit = fast_sed_batch_fitter(self.wavelengths, self.fluxes, self.covar, self.betain, self.alphain, T_range=self.T_range)
+            T = np.clip(fit['T_observed'], self.T_range[0], self.T_range[1])
+            A = self.start_amplitudes(fit['A'], T)
+            center = np.array([np.log10(A), T]).T
+            width = np.array([fit['A_err'] / A / np.log(10.), fit['T_observed_err']]).T
+            width = np.where(np.isfinite(width) & (width > 0), width, np.abs(center) * scatter)
+            p0 = center[:,None,:] + scatter * width[:,None,:] * self.random.randn(self.nb, self.nwalkers, self.ndim)
+            p0[:,:,1] = np.clip(p0[:,:,1], self.T_range[0] * (1 + 1e-6), self.T_range[1] * (1 - 1e-6))
+            p0[:,:,0] = np.clip(p0[:,:,0], self.log10A_range[0] + 1e-6, self.log10A_range[1] - 1e-6)
+        self.position = np.array(p0, dtype=float)
+        self.lnprob = self.log_prob(self.position)
+
+    def start_amplitudes(self, A, T):
+        ''' fast_sed_batch_fitter amplitudes, with bins it leaves at A <= 0 (noise-dominated)
+        replaced by |profile amplitude| at T, floored so log10 A stays finite and in log10A_range
+        '''
+        A = np.array(A, dtype=float)
+        good = np.isfinite(A) & (A > 0)
+        if np.all(good):
+            return A
+        unit = greybody_kernel(np.ones(self.nb), T, self.nu_in, self.betain, self.alphain)
+        if self.covar.ndim == 3:
+            profile = np.einsum('bi,bij,bj->b', unit, self.precision, self.fluxes) / np.einsum('bi,bij,bj->b', unit, self.precision, unit)
+        else:
+            profile = np.sum(self.weights * unit * self.fluxes, axis=1) / np.sum(self.weights * unit**2, axis=1)
+        profile = np.where(np.isfinite(profile), np.abs(profile), 0.0)
+        A_floor = max(np.min(A[good]) * 1e-3 if np.any(good) else np.max(profile) * 1e-3, 10**self.log10A_range[0])
+        A[~good] = np.maximum(profile, A_floor)[~good]
+        return np.clip(A, 10**self.log10A_range[0], 10**self.log10A_range[1])
+
+    def step(self):
+        ''' One stretch-move update of both halves of the ensemble, for all bins '''
+        half = self.nwalkers // 2
+        for first, second in [(slice(0, half), slice(half, None)), (slice(half, None), slice(0, half))]:
+            x = self.position[:,first]
+            partners = self.position[:,second][np.arange(self.nb)[:,None], self.random.randint(half, size=(self.nb, half))]
+            z = ((self.a - 1.0) * self.random.rand(self.nb, half) + 1.0)**2 / self.a
+            proposal = partners + z[:,:,None] * (x - partners)
+            lnprob_new = self.log_prob(proposal)
+            with np.errstate(invalid='ignore'):
+                lnratio = (self.ndim - 1.0) * np.log(z) + lnprob_new - self.lnprob[:,first]
+            accept = np.log(self.random.rand(self.nb, half)) < lnratio
+            x[accept] = proposal[accept]
+            self.lnprob[:,first][accept] = lnprob_new[accept]
+            self.naccepted[:,first] += accept
+
+    def run(self, nsteps, thin=1, checkpoint=None, checkpoint_every=1000):
+        ''' Take nsteps steps, keeping every thin-th in chain [n_bins, nwalkers, nsamples, 2].
+        With checkpoint = filename, the sampler resumes from that file if it exists and
+        saves itself there every checkpoint_every steps and at the end; nsteps is then the
+        total, so a resumed run only takes the steps still missing.
+        '''
+        if checkpoint != None and os.path.exists(checkpoint):
+            self.load(checkpoint)
+            nsteps = max(nsteps - self.iterations, 0)
+        if self.position is None:
+            self.initialize()
+
+        samples = []
+        lnprobs = []
+        for i in range(nsteps):
+            self.step()
+            self.iterations += 1
+            if self.iterations % thin == 0:
+                samples.append(self.position.copy())
+                lnprobs.append(self.lnprob.copy())
+            if checkpoint != None and self.iterations % checkpoint_every == 0:
+                self.append(samples, lnprobs)
+                samples = []
+                lnprobs = []
+                self.save(checkpoint)
+
+        self.append(samples, lnprobs)
+        if checkpoint != None:
+            self.save(checkpoint)
+        return self.chain
+
+    def append(self, samples, lnprobs):
+        if len(samples):
+            self.chain = np.concatenate([self.chain, np.stack(samples, axis=2)], axis=2)
+            self.lnprobability = np.concatenate([self.lnprobability, np.stack(lnprobs, axis=2)], axis=2)
+
+    def save(self, filename):
+        state = self.random.get_state()
+        np.savez(filename, position=self.position, lnprob=self.lnprob, chain=self.chain,
+            lnprobability=self.lnprobability, naccepted=self.naccepted, iterations=self.iterations,
+            rng_keys=state[1], rng_pos=state[2], rng_has_gauss=state[3], rng_cached_gaussian=state[4])
+
+    def load(self, filename):
+        saved = np.load(filename)
+        if np.shape(saved['position']) != (self.nb, self.nwalkers, self.ndim):
+            raise ValueError("checkpoint {} has walkers {}, expected {}".format(filename, np.shape(saved['position']), (self.nb, self.nwalkers, self.ndim)))
+        self.position = saved['position']
+        self.lnprob = saved['lnprob']
+        self.chain = saved['chain']
+        self.lnprobability = saved['lnprobability']
+        self.naccepted = saved['naccepted']
+        self.iterations = int(saved['iterations'])
+        self.random.set_state(('MT19937', saved['rng_keys'], int(saved['rng_pos']),
+            int(saved['rng_has_gauss']), float(saved['rng_cached_gaussian'])))
+
+    def acceptance_fraction(self):
+        return self.naccepted / max(self.iterations, 1)
+
+    def flatchain(self, burn=0):
+        ''' Samples [n_bins, nwalkers * nsamples, 2] after dropping the first burn kept samples '''
+        return np.reshape(self.chain[:,:,burn:], (self.nb, -1, self.ndim))
+
+    def percentiles(self, q=[16, 50, 84], burn=0):
+        ''' Percentiles [len(q), n_bins, 2] of (log10 A, T_observed) for every bin '''
+        return np.percentile(self.flatchain(burn), q, axis=1)
@@ -0,0 +1,113 @@
+import os
+import hashlib
+import numpy as np
+from utils import greybody_kernel
+
+c = 299792458.0 # m/s
+
+class SedTemplateGrid:
+
+    def __init__(self, wavelengths, betas=[1.8], alphas=[2.0], T_min=1.0, T_max=150.0, nT=4000,
+        cpath='/data/pickles/simstack/sed_templates/', cfile=None):
+        ''' Tabulated unit-amplitude SEDs (greybody_kernel with A=1) on a
+        (beta, alpha, T_observed, wavelength) grid, with T_observed uniform in log.
+        The grid is built once and saved to cpath (set cpath=None to keep it in memory only);
+        later instances with the same definition load it from disk.
+        Evaluation linearly interpolates in log T, so an SED is a couple of gathers
+        instead of black() and np.exp.  The worst relative interpolation error,
+        measured against the exact SED at the midpoints of the T grid, is stored in max_error.
+        '''
+        self.wavelengths = np.ravel(np.asarray(wavelengths, dtype=np.float64))
+        self.betas = np.ravel(np.asarray(betas, dtype=np.float64))
+        self.alphas = np.ravel(np.asarray(alphas, dtype=np.float64))
+        self.logT_min = np.log(T_min)
+        self.dlogT = (np.log(T_max) - np.log(T_min)) / (nT - 1)
+        self.T_grid = np.exp(self.logT_min + self.dlogT * np.arange(nT))
+        self.node_indices = {}
+
+        if cfile == None:
+            key = repr([self.wavelengths.tolist(), self.betas.tolist(), self.alphas.tolist(), T_min, T_max, nT])
+            cfile = 'sed_template_grid_' + hashlib.sha1(key).hexdigest()[:16] + '.npz'
+
+        if cpath != None and os.path.exists(os.path.join(cpath, cfile)):
+            cached = np.load(os.path.join(cpath, cfile))
+            self.seds = cached['seds']
+            self.max_error = float(cached['max_error'])
+        else:
+            self.build()
+            if cpath != None:
+                if not os.path.exists(cpath):
+                    os.makedirs(cpath)
+                np.savez(os.path.join(cpath, cfile), seds=self.seds, max_error=self.max_error)
+
+    def build(self):
+        nu_in = c * 1.e6 / self.wavelengths
+        T_mid = np.sqrt(self.T_grid[1:] * self.T_grid[:-1])
+        nb = len(self.betas)
+        na = len(self.alphas)
+        self.seds = np.zeros([nb, na, len(self.T_grid), len(nu_in)])
+        self.max_error = 0.0
+        for ib in range(nb):
+            for ia in range(na):
+                self.seds[ib,ia] = greybody_kernel(1.0, self.T_grid, nu_in, self.betas[ib], self.alphas[ia])
+                exact = greybody_kernel(1.0, T_mid, nu_in, self.betas[ib], self.alphas[ia])
+                interp = 0.5 * (self.seds[ib,ia,1:] + self.seds[ib,ia,:-1])
+                ind = exact > 0
+                self.max_error = max(self.max_error, np.max(np.abs(interp[ind] / exact[ind] - 1.0)))
+
+    def node_index(self, nodes, value, name):
+        ind = np.where(np.isclose(nodes, value))[0]
+        if len(ind) == 0:
+            raise ValueError("{}={} is not on the template grid {}".format(name, value, nodes))
+        return ind[0]
+
+    def sed(self, A, T, wavelengths, betain=1.8, alphain=2.0, dtype=np.float64, out=None):
+        ''' Same as greybody_kernel(A, T, c*1e6/wavelengths, betain, alphain, dtype, out), read from the grid.
+        wavelengths must be a subset of the grid wavelengths; betain and alphain (scalars or
+        per-galaxy arrays) must be grid nodes.  Rows with T outside the grid fall back to the exact kernel.
+        '''
+        wavelengths = np.ravel(wavelengths)
+        A = np.reshape(np.asarray(A, dtype=np.float64), (-1,1))
+        T = np.reshape(np.asarray(T, dtype=np.float64), (-1,1))
+        betain = np.reshape(np.asarray(betain, dtype=np.float64), (-1,1))
+        alphain = np.reshape(np.asarray(alphain, dtype=np.float64), (-1,1))
+        ng = np.broadcast(A, T, betain, alphain).shape[0]
+        A, T, betain, alphain = [np.broadcast_to(x, (ng,1))[:,0] for x in (A, T, betain, alphain)]
+
+        if out is None:
+            out = np.empty([ng, len(wavelengths)], dtype=dtype)
+        elif np.shape(out) != (ng, len(wavelengths)):
+            raise ValueError("out has shape {}, expected {}".format(np.shape(out), (ng, len(wavelengths))))
+
+        pairs = np.array([betain, alphain]).T
+        for beta, alpha in np.unique(pairs, axis=0):
+            rows = np.where((betain == beta) & (alphain == alpha))[0]
+            if len(rows) == ng:
+                out[:] = self.sed_nodes(A, T, wavelengths, beta, alpha)
+            else:
+                out[rows] = self.sed_nodes(A[rows], T[rows], wavelengths, beta, alpha)
+
+        return out
+
+    def sed_nodes(self, A, T, wavelengths, betain, alphain):
+        key = (float(betain), float(alphain)) + tuple(wavelengths)
+        if key not in self.node_indices:
+            self.node_indices[key] = (self.node_index(self.betas, key[0], 'beta'),
+                self.node_index(self.alphas, key[1], 'alpha'),
+                np.array([self.node_index(self.wavelengths, w, 'wavelength') for w in wavelengths]))
+        ib, ia, iw = self.node_indices[key]
+
+        u = (np.log(T) - self.logT_min) / self.dlogT
+        iT = np.clip(np.floor(u).astype(int), 0, len(self.T_grid) - 2)
+        f = np.reshape(u - iT, (-1,1))
+
+        table = self.seds[ib,ia]
+        sed = table[iT[:,None],iw] * (1.0 - f) + table[iT[:,None]+1,iw] * f
+        sed *= np.reshape(A, (-1,1))
+
+        outside = np.where((u < 0) | (u > len(self.T_grid) - 1))[0]
+        if len(outside):
+            nu_in = c * 1.e6 / wavelengths
+            sed[outside] = greybody_kernel(A[outside], T[outside], nu_in, self.betas[ib], self.alphas[ia])
+
+        return sed
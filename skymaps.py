@@ -1,9 +1,15 @@
 import pdb
+import os
 import six
+import hashlib
 import numpy as np
 from astropy.io import fits
 import astropy.units as u
-from utils import bin_ndarray as rebin
+from astropy.wcs import WCS
+from collections import OrderedDict
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from scipy.ndimage import map_coordinates
 from utils import gauss_kern
 from utils import clean_nans
 from utils import clean_args
@@ -12,29 +18,161 @@ from astropy import cosmology
 from astropy.cosmology import Planck15 as cosmo
 from astropy.cosmology import Planck15, z_at_value
 
+resampled_beams = {}
+
+def resample_beam(beam,pix_beam,pix):
+	''' Resample a beam image from pix_beam to pix arcsec pixels, keeping it centred on the
+	central pixel of an odd-sized output.  Values come from a cubic spline averaged over
+	subpixels of each output pixel (so coarser pixels are integrated, not point-sampled),
+	then rescaled so that sum(kern) * pix^2 equals sum(beam) * pix_beam^2. '''
+	beam = clean_nans(np.array(beam, dtype=np.float64))
+	scale = pix_beam / pix
+	new_shape = [int(np.round(n * scale)) for n in np.shape(beam)]
+	new_shape = [n + 1 - n % 2 for n in new_shape]
+	nsub = int(np.ceil(1. / scale))
+	sub = (np.arange(nsub) + 0.5) / nsub - 0.5
+	axes = []
+	for n_old, n_new in zip(np.shape(beam), new_shape):
+		offsets = (np.arange(n_new)[:,None] - (n_new - 1) / 2. + sub[None,:]) * pix
+		axes.append(np.ravel((n_old - 1) / 2. + offsets / pix_beam))
+	yy, xx = np.meshgrid(axes[0], axes[1], indexing='ij')
+	kern = map_coordinates(beam, [yy, xx], order=3, mode='constant', cval=0.0)
+	kern = kern.reshape(new_shape[0], nsub, new_shape[1], nsub).mean(axis=(1,3))
+	kern *= np.sum(beam) * pix_beam**2 / (np.sum(kern) * pix**2)
+	return kern
+
+def resampled_beam(file_beam,beam,pix_beam,pix,cpath=None):
+	''' resample_beam, cached in memory and (with cpath) on disk per (beam file contents, pix) '''
+	key = file_digest(file_beam).hexdigest() + '_{:.6f}'.format(pix)
+	if key not in resampled_beams:
+		cfile = None
+		if cpath != None:
+			cfile = os.path.join(cpath, 'beam_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.npy')
+		if cfile != None and os.path.exists(cfile):
+			resampled_beams[key] = np.load(cfile)
+		else:
+			resampled_beams[key] = resample_beam(beam, pix_beam, pix)
+			if cfile != None:
+				if not os.path.exists(cpath):
+					os.makedirs(cpath)
+				np.save(cfile, resampled_beams[key])
+	return resampled_beams[key].copy()
+
+def file_digest(filename,sha=None,blocksize=2**24):
+	''' sha1 of a file's contents, read blocksize bytes at a time '''
+	if sha is None:
+		sha = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		block = f.read(blocksize)
+		while block:
+			sha.update(block)
+			block = f.read(blocksize)
+	return sha
+
+def skymap_cache_key(file_map,file_noise,psf,color_correction,beam_area,lazy):
+	''' Cache directory name for Skymaps: hash of the input files and constructor arguments '''
+	sha = hashlib.sha1()
+	files = [file_map]
+	if file_noise != file_map:
+		files.append(file_noise)
+	if isinstance(psf, six.string_types):
+		files.append(psf)
+	for filename in files:
+		file_digest(filename, sha)
+	sha.update(repr([file_noise == file_map, psf if not isinstance(psf, six.string_types) else None,
+		color_correction, beam_area, lazy]).encode('utf-8'))
+	return 'skymap_' + sha.hexdigest()[:16]
+
+#One block of a map: data with halo, valid-pixel mask, (row, col) of its first pixel in the
+#full map, and the slices of the block (without halo) that it owns
+MapTile = namedtuple('MapTile', ['map', 'noise', 'mask', 'offsets', 'core'])
+
+def tile_sections(shape,tile_size=1024,halo=0):
+	''' (section, core) pairs covering a 2D shape in tile_size blocks padded by halo pixels
+	(clipped at the edges): section slices the full map, core slices the section '''
+	for y0 in range(0, shape[0], tile_size):
+		for x0 in range(0, shape[1], tile_size):
+			y1 = min(y0 + tile_size, shape[0])
+			x1 = min(x0 + tile_size, shape[1])
+			ya = max(y0 - halo, 0)
+			xa = max(x0 - halo, 0)
+			section = (slice(ya, min(y1 + halo, shape[0])), slice(xa, min(x1 + halo, shape[1])))
+			core = (slice(y0 - ya, y1 - ya), slice(x0 - xa, x1 - xa))
+			yield section, core
+
+def stitch_tiles(results,shape,out=None,dtype=np.float64):
+	''' Assemble (tile, array) pairs, each array shaped like tile.map, into a full map,
+	keeping only the core of every tile.  out can be an array, or a filename to write a
+	.npy memmap; otherwise a new array is returned. '''
+	if out is None:
+		out = np.zeros(shape, dtype=dtype)
+	elif isinstance(out, six.string_types):
+		out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=tuple(shape))
+	for tile, result in results:
+		y0 = tile.offsets[0] + tile.core[0].start
+		x0 = tile.offsets[1] + tile.core[1].start
+		block = np.asarray(result)[tile.core]
+		out[y0:y0+block.shape[0], x0:x0+block.shape[1]] = block
+	return out
+
 class Skymaps:
 
-	def __init__(self,file_map,file_noise,psf,color_correction=1.0,beam_area=1.0,wavelength=None,fwhm=None):
+	def __init__(self,file_map,file_noise,psf,color_correction=1.0,beam_area=1.0,wavelength=None,fwhm=None,lazy=False,silent=False,cpath=None):
 		''' This Class creates Objects for a set of
 		maps/noisemaps/beams/TransferFunctions/etc.,
 		at each Wavelength.
 		This is a work in progress!
-		Issues:  If the beam has a different pixel size from the map,
-		it is not yet able to re-scale it.
-		Just haven't found a convincing way to make it work.
+		If the beam has a different pixel size from the map, it is
+		resampled onto the map pixels (see resample_beam).
+		psf keeps the scale of the beam file (a Gaussian psf has peak 1).
+		Resampling conserves its integral, so the peak of a resampled psf
+		can fall below the file's; psf_peak is the peak of the beam as
+		given, and sum(psf) * pixel area / psf_peak its solid angle.
 		Future Work:
 		Will shift some of the work into functions (e.g., read psf,
 		color_correction) and increase flexibility.
+		lazy=True memory-maps the FITS data instead of reading it:
+		map, noise, rms and map_peak are computed on first access and cached,
+		and map_section/noise_section clean and scale just one block.
+		In both modes map is divided by its peak, map_peak (map_rms
+		normalizes the map this way in the default mode; lazy mode
+		finds the peak in one streamed pass and applies it to every
+		section), so map, its tiles and rms agree between the modes.
+		cpath is a directory for an on-disk cache of the preprocessed map, noise, psf
+		and scalars, keyed by a hash of the input files and arguments; later runs
+		memory-map the cached arrays (copy-on-write) instead of redoing the work.
+		In lazy mode the constructor only caches psf and scalars; map and noise
+		are streamed to the cache the first time they are accessed.
 		'''
+		self.lazy = lazy
+		if cpath != None:
+			self.cache_dir = os.path.join(cpath, skymap_cache_key(file_map, file_noise, psf, color_correction, beam_area, lazy))
+			if self.load_cache():
+				if wavelength != None:
+					self.add_wavelength(wavelength)
+				if fwhm != None:
+					self.add_fwhm(fwhm)
+				return
+
 		#READ MAPS
 		if file_map == file_noise:
 			#SPIRE Maps have Noise maps in the second extension.
-			cmap, hd = fits.getdata(file_map, 1, header = True)
-			cnoise, nhd = fits.getdata(file_map, 2, header = True)
+			ext_map = (file_map, 1)
+			ext_noise = (file_map, 2)
 		else:
 			#This assumes that if Signal and Noise are different maps, they are contained in first extension
-			cmap, hd = fits.getdata(file_map, 0, header = True)
-			cnoise, nhd = fits.getdata(file_noise, 0, header = True)
+			ext_map = (file_map, 0)
+			ext_noise = (file_noise, 0)
+		if lazy:
+			self.hdulists = [fits.open(file_map, memmap = True)]
+			if file_noise != file_map:
+				self.hdulists.append(fits.open(file_noise, memmap = True))
+			cmap = self.hdulists[0][ext_map[1]].data
+			hd = self.hdulists[0][ext_map[1]].header
+			cnoise = self.hdulists[-1][ext_noise[1]].data
+		else:
+			cmap, hd = fits.getdata(ext_map[0], ext_map[1], header = True)
+			cnoise, nhd = fits.getdata(ext_noise[0], ext_noise[1], header = True)
 
 		#GET MAP PIXEL SIZE
 		if 'CD2_2' in hd:
@@ -54,36 +192,155 @@ class Skymaps:
 			else: pix_beam = pix
 			#SCALE PSF IF NECESSARY
 			if np.round(10.*pix_beam) != np.round(10.*pix):
-				raise ValueError("Beam and Map have different size pixels")
-				scale_beam = pix_beam / pix
-				pms = np.shape(beam)
-				new_shape=(np.round(pms[0]*scale_beam),np.round(pms[1]*scale_beam))
-				#pdb.set_trace()
-				kern = rebin(clean_nans(beam),new_shape=new_shape,operation='ave')
-				#kern = rebin(clean_nans(beam),new_shape[0],new_shape[1])
+				kern = resampled_beam(psf, beam, pix_beam, pix, cpath=cpath)
 			else:
 				kern = clean_nans(beam)
 			self.psf_pixel_size = pix_beam
+			self.psf_peak = float(np.max(clean_nans(np.array(beam, dtype=np.float64))))
 		else:
 			sig = psf / 2.355 / pix
 			#pdb.set_trace()
 			#kern = gauss_kern(psf, np.floor(psf * 8.), pix)
 			kern = gauss_kern(psf, np.floor(psf * 8.)/pix, pix)
+			self.psf_peak = 1.0
 
-		self.map = clean_nans(cmap) * color_correction
-		self.noise = clean_nans(cnoise,replacement_char=1e10) * color_correction
-		if beam_area != 1.0:
-			self.beam_area_correction(beam_area)
+		self.color_correction = color_correction
+		self.beam_area = beam_area
 		self.header = hd
 		self.pixel_size = pix
 		self.psf = clean_nans(kern)
-		self.rms = map_rms(self.map, silent=False)
+		if lazy:
+			self.raw_map = cmap
+			self.raw_noise = cnoise
+		else:
+			self.map = clean_nans(cmap) * color_correction
+			self.noise = clean_nans(cnoise,replacement_char=1e10) * color_correction
+			if beam_area != 1.0:
+				self.beam_area_correction(beam_area)
+			self.map_peak = np.max(self.map)
+			self.rms = map_rms(self.map, silent=silent)
 
 		if wavelength != None:
-			add_wavelength(wavelength)
+			self.add_wavelength(wavelength)
 
 		if fwhm != None:
-			add_fwhm(fwhm)
+			self.add_fwhm(fwhm)
+
+		if cpath != None:
+			self.save_cache()
+
+	def __getattr__(self,name):
+		#Lazy mode: derived products are built on first access, then cached as attributes
+		if not self.__dict__.get('lazy', False) or name not in ['map','noise','rms','map_peak']:
+			raise AttributeError(name)
+		if name == 'map':
+			self.map = self.stream_cache('map', self.map_section) if 'cache_dir' in self.__dict__ else self.map_section()
+		elif name == 'noise':
+			self.noise = self.stream_cache('noise', self.noise_section) if 'cache_dir' in self.__dict__ else self.noise_section()
+		elif name == 'map_peak':
+			#The peak of the cleaned, scaled map that the default mode's map_rms divides by
+			self.map_peak = max(np.max(self.scale_section(clean_nans(np.array(self.raw_map[section]))))
+				for section, core in tile_sections(np.shape(self.raw_map)))
+			if 'cache_dir' in self.__dict__:
+				self.save_cache_scalars()
+		elif name == 'rms':
+			self.rms = map_rms(np.array(self.map), silent=True)
+			if 'cache_dir' in self.__dict__:
+				self.save_cache_scalars()
+		return self.__dict__[name]
+
+	def save_cache(self):
+		''' Write map, noise and psf as .npy and the scalars.  In lazy mode map and noise are
+		left to stream_cache, on first access, so only psf and scalars are written here. '''
+		if not os.path.exists(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		if not self.lazy:
+			np.save(os.path.join(self.cache_dir, 'map.npy'), self.map)
+			np.save(os.path.join(self.cache_dir, 'noise.npy'), self.noise)
+		np.save(os.path.join(self.cache_dir, 'psf.npy'), self.psf)
+		self.save_cache_scalars()
+
+	def stream_cache(self,name,section):
+		''' Write the cleaned, scaled map or noise (section = map_section or noise_section) to
+		the cache one tile at a time, rename it into place, and memory-map it copy-on-write '''
+		filename = os.path.join(self.cache_dir, name + '.npy')
+		tmp = os.path.join(self.cache_dir, name + '_tmp.npy')
+		shape = self.map_shape()
+		out = np.lib.format.open_memmap(tmp, mode='w+', dtype=section((slice(0,1),slice(0,1))).dtype, shape=tuple(shape))
+		for block, core in tile_sections(shape):
+			out[block] = section(block)
+		out.flush()
+		del out
+		os.rename(tmp, filename)
+		return np.load(filename, mmap_mode='c')
+
+	def save_cache_scalars(self):
+		#Written last and renamed into place, so a complete scalars.npz marks a complete psf and
+		#scalars (and, outside lazy mode, map and noise)
+		tmp = os.path.join(self.cache_dir, 'scalars_tmp.npz')
+		np.savez(tmp, header=self.header.tostring(), pixel_size=self.pixel_size,
+			psf_pixel_size=self.__dict__.get('psf_pixel_size', np.nan), psf_peak=self.psf_peak, rms=self.__dict__.get('rms', np.nan),
+			map_peak=self.__dict__.get('map_peak', np.nan),
+			color_correction=self.color_correction, beam_area=self.beam_area)
+		os.rename(tmp, os.path.join(self.cache_dir, 'scalars.npz'))
+
+	def load_cache(self):
+		''' Load what the cache holds; True only if map and noise were cached too (a lazy
+		cache has them once they have been accessed), otherwise the caller reopens the files '''
+		if not os.path.exists(os.path.join(self.cache_dir, 'scalars.npz')):
+			return False
+		scalars = np.load(os.path.join(self.cache_dir, 'scalars.npz'))
+		self.header = fits.Header.fromstring(str(scalars['header']))
+		self.pixel_size = float(scalars['pixel_size'])
+		if np.isfinite(scalars['psf_pixel_size']):
+			self.psf_pixel_size = float(scalars['psf_pixel_size'])
+		if np.isfinite(scalars['rms']):
+			self.rms = float(scalars['rms'])
+		if 'map_peak' in scalars and np.isfinite(scalars['map_peak']):
+			self.map_peak = scalars['map_peak'][()]
+		self.color_correction = float(scalars['color_correction'])
+		self.beam_area = float(scalars['beam_area'])
+		self.psf = np.load(os.path.join(self.cache_dir, 'psf.npy'))
+		self.psf_peak = float(scalars['psf_peak']) if 'psf_peak' in scalars else float(np.max(self.psf))
+		for name in ['map', 'noise']:
+			if os.path.exists(os.path.join(self.cache_dir, name + '.npy')):
+				self.__dict__[name] = np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='c')
+		return 'map' in self.__dict__ and 'noise' in self.__dict__
+
+	def scale_section(self,section):
+		#Same operations, in the same order and dtype, as the default mode applies to the full map
+		section *= self.color_correction
+		if self.beam_area != 1.0:
+			section *= self.beam_area * 1e6
+		return section
+
+	def map_section(self,section=Ellipsis):
+		''' Cleaned, scaled, peak-normalized map[section], read from disk in lazy mode '''
+		if 'raw_map' not in self.__dict__ or 'map' in self.__dict__:
+			return self.map[section]
+		cmap = self.scale_section(clean_nans(np.array(self.raw_map[section])))
+		cmap /= self.map_peak
+		return cmap
+
+	def noise_section(self,section=Ellipsis):
+		''' Cleaned, scaled noise[section], read from disk in lazy mode '''
+		if 'raw_noise' not in self.__dict__ or 'noise' in self.__dict__:
+			return self.noise[section]
+		return self.scale_section(clean_nans(np.array(self.raw_noise[section]),replacement_char=1e10))
+
+	def map_shape(self):
+		if 'raw_map' in self.__dict__ and 'map' not in self.__dict__:
+			return np.shape(self.raw_map)
+		return np.shape(self.map)
+
+	def tiles(self,tile_size=1024,halo=0):
+		''' Iterate over MapTiles of tile_size x tile_size pixels plus a halo on each side.
+		In lazy mode only one tile is read and cleaned at a time; otherwise tiles are views
+		of map and noise.  mask marks valid pixels (map != 0 after cleaning, as in map_rms).
+		Use stitch_tiles to put per-tile results back together. '''
+		for section, core in tile_sections(self.map_shape(), tile_size, halo):
+			cmap = self.map_section(section)
+			yield MapTile(cmap, self.noise_section(section), cmap != 0, (section[0].start, section[1].start), core)
 
 	def beam_area_correction(self,beam_area):
 		self.map *= beam_area * 1e6
@@ -99,3 +356,52 @@ class Skymaps:
 		weights, whd = fits.getdata(file_weights, 0, header = True)
 		#pdb.set_trace()
 		self.noise = clean_nans(1./weights,replacement_char=1e10)
+
+class SkymapCollection:
+
+	def __init__(self,bands,nthreads=4,**kwargs):
+		''' Several Skymaps loaded concurrently on a thread pool (FITS reads release the GIL).
+		bands is a dict of band name -> Skymaps keyword arguments (file_map, file_noise, psf,
+		and optionally color_correction, beam_area, wavelength, fwhm); kwargs (e.g. lazy=True)
+		apply to every band.  map_rms runs with silent=True unless given, so no plots are made
+		from worker threads.  Bands are kept in order of wavelength (then name), with a WCS,
+		pixel size [arcsec] and beam solid angle [sr] per band.
+		'''
+		kwargs.setdefault('silent', True)
+		names = list(bands.keys())
+		def load(name):
+			args = dict(kwargs)
+			args.update(bands[name])
+			return Skymaps(**args)
+
+		pool = ThreadPool(max(1, min(nthreads, len(names))))
+		loaded = pool.map(load, names)
+		pool.close()
+		pool.join()
+
+		order = sorted(range(len(names)), key=lambda i: (getattr(loaded[i], 'wavelength', None), names[i]))
+		self.maps = OrderedDict((names[i], loaded[i]) for i in order)
+		self.wcs = OrderedDict()
+		self.pixel_size = OrderedDict()
+		self.beam_solid_angle = OrderedDict()
+		for name in self.maps:
+			skymap = self.maps[name]
+			self.wcs[name] = WCS(skymap.header, naxis = 2)
+			self.pixel_size[name] = skymap.pixel_size
+			pix_sr = (skymap.pixel_size / 3600. * np.pi / 180.)**2
+			self.beam_solid_angle[name] = np.sum(skymap.psf) / skymap.psf_peak * pix_sr
+
+	def __getitem__(self,name):
+		return self.maps[name]
+
+	def __iter__(self):
+		return iter(self.maps.items())
+
+	def __len__(self):
+		return len(self.maps)
+
+	def keys(self):
+		return list(self.maps.keys())
+
+	def wavelengths(self):
+		return [getattr(self.maps[name], 'wavelength', None) for name in self.maps]
@@ -0,0 +1,27 @@
+import os
+import tempfile
+import numpy as np
+from utils import greybody_kernel
+from bandpass import Bandpasses
+
+def write_filters(fpath):
+    ''' Gaussian responses, 8% wide, around the nominal SPIRE 250 and MIPS 24 wavelengths '''
+    for filename, l0 in [('spire_250.txt', 250.), ('mips_24.txt', 23.68)]:
+        lam = np.linspace(0.8 * l0, 1.2 * l0, 200)
+        np.savetxt(os.path.join(fpath, filename), np.c_[lam, np.exp(-0.5 * ((lam - l0) / (0.08 * l0))**2)])
+    return fpath
+
+def test_reference_spectrum_returns_nominal_flux():
+    bp = Bandpasses(['SPIRE_250', 'MIPS_24'], fpath=write_filters(tempfile.mkdtemp()))
+    for i in range(2):
+        seds = 3.0 * (bp.nu[None,:] / bp.nu0[i])**-1.0
+        assert abs(bp.band_fluxes(seds)[0,i] / 3.0 - 1.) < 1e-6
+
+def test_greybody_band_fluxes_match_direct_product_across_chunks():
+    bp = Bandpasses(['SPIRE_250', 'MIPS_24'], fpath=write_filters(tempfile.mkdtemp()))
+    A = np.array([1e-38, 2e-38, 3e-38])
+    T = np.array([10., 20., 40.])
+    direct = np.dot(greybody_kernel(A, T, bp.nu, [1.5, 1.8, 2.0], 2.0), bp.weights.T)
+    assert np.allclose(bp.greybody_band_fluxes(A, T, [1.5, 1.8, 2.0], chunk_size=2), direct, rtol=1e-12)
+    cc = bp.color_corrections(T)
+    assert np.allclose(cc * greybody_kernel(1.0, T, bp.nu0), bp.greybody_band_fluxes(1.0, T), rtol=1e-12)
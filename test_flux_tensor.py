@@ -0,0 +1,31 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+from flux_tensor import build_flux_tensor
+from invert_sed import invert_sed_exact
+
+def test_lookup_matches_exact_on_coarse_grid():
+    filename = os.path.join(tempfile.mkdtemp(), 'flux_tensor.npy')
+    lam = [250., 350., 500.]
+    ft = build_flux_tensor(filename, lam, np.arange(0.05, 6.01, 0.1), np.logspace(1, np.log10(80.), 60))
+    r = np.random.RandomState(1)
+    n = 2000
+    zin = r.uniform(0.1, 5.9, n)
+    Trf = r.uniform(15., 70., n)
+    logL = r.uniform(9.5, 12.5, n)
+    exact = invert_sed_exact(np.array(lam), Trf, 10**logL, zin)
+    assert np.max(np.abs(ft.lookup(zin, Trf, logL) / exact - 1.)) < 1e-2
+
+    shared = pickle.loads(pickle.dumps(ft))
+    assert isinstance(shared.tensor, np.memmap)
+    assert np.allclose(shared.lookup(zin[:10], Trf[:10], logL[:10]), ft.lookup(zin[:10], Trf[:10], logL[:10]))
+
+def test_lookup_rejects_out_of_range():
+    filename = os.path.join(tempfile.mkdtemp(), 'flux_tensor.npy')
+    ft = build_flux_tensor(filename, [350.], [0.5, 1., 2.], [20., 40.])
+    try:
+        ft.lookup(3., 30., 11.)
+    except ValueError:
+        return
+    assert False
@@ -0,0 +1,53 @@
+import numpy as np
+from invert_sed import AmplitudeTable
+from invert_sed import amplitude_from_greybody
+
+def test_amplitude_table_matches_exact():
+	table = AmplitudeTable(betas = [1.8, 2.0], alphain = 2.0, T_min = 5., T_max = 60., nT = 200)
+	Trf = np.array([20., 35., 50.])
+	zin = np.array([0.5, 1.5, 3.0])
+	exact = amplitude_from_greybody(Trf, 1e11, zin, b = 1.8)
+	assert np.allclose(amplitude_from_greybody(Trf, 1e11, zin, b = 1.8, table = table), exact, rtol = 2 * table.max_error)
+
+def test_amplitude_table_rejects_other_alpha():
+	table = AmplitudeTable(betas = [2.0], alphain = 2.0, T_min = 5., T_max = 60., nT = 50)
+	try:
+		amplitude_from_greybody(30., 1e11, 1.0, b = 2.0, alphain = 1.5, table = table)
+	except ValueError:
+		return
+	assert False
+
+def test_fluxes_from_catalog_matches_exact_and_streams():
+	from invert_sed import fluxes_from_catalog
+	from invert_sed import invert_sed_exact
+	r = np.random.RandomState(0)
+	ngal = 250
+	zin = r.uniform(0.2, 3., ngal)
+	Trf = r.uniform(20., 50., ngal)
+	Lrf = 10**r.uniform(10., 12., ngal)
+	lam = np.array([250., 350., 500.])
+	exact = invert_sed_exact(lam, Trf, Lrf, zin)
+	fluxes = fluxes_from_catalog(lam, zin, Trf, Lrf, chunk_size = 60)
+	assert np.allclose(fluxes, exact, rtol = 1e-4)
+
+	import invert_sed
+	events = []
+	compute = invert_sed.catalog_flux_chunk
+	def recording_chunk(args):
+		events.append('compute')
+		return compute(args)
+	class Recorder(np.ndarray):
+		def __setitem__(self, key, value):
+			events.append('write')
+			np.ndarray.__setitem__(self, key, value)
+	out = np.zeros([ngal, len(lam)]).view(Recorder)
+	invert_sed.catalog_flux_chunk = recording_chunk
+	try:
+		fluxes_from_catalog(lam, zin, Trf, Lrf, chunk_size = 60, out = out)
+	finally:
+		invert_sed.catalog_flux_chunk = compute
+	assert events == ['compute', 'write'] * 5
+	assert np.allclose(out, exact, rtol = 1e-4)
+
+	parallel = fluxes_from_catalog(lam, zin, Trf, Lrf, chunk_size = 60, nproc = 2)
+	assert np.allclose(parallel, fluxes)
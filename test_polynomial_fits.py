@@ -0,0 +1,44 @@
+import numpy as np
+from lmfit import Parameters
+from polynomial_fits import L_vs_z_m_polynomial_fn
+from polynomial_fits import L_vs_z_m_ridge_fit
+from polynomial_fits import polynomial_coefficients
+
+def surface_params(seed=0, degreeA=3, degreeB=2):
+	r = np.random.RandomState(seed)
+	p = Parameters()
+	p.add('degreeA', value = degreeA, vary = False)
+	p.add('degreeB', value = degreeB, vary = False)
+	for i in range(degreeA):
+		for j in range(degreeB):
+			p.add(str('A'+str(i)+str(j)), value = r.randn())
+	return p
+
+def test_polygrid_matches_double_loop():
+	p = surface_params()
+	zz = np.linspace(0.1, 4, 7)
+	mm = np.linspace(9, 12, 5)
+	expected = np.zeros([7, 5])
+	for i in range(3):
+		for j in range(2):
+			expected += p['A'+str(i)+str(j)].value * zz[:,None]**i * mm[None,:]**j
+	assert np.allclose(L_vs_z_m_polynomial_fn(p, zz, mm), expected)
+
+def test_ridge_fit_matches_normal_equations():
+	p = surface_params()
+	zz = np.linspace(0.1, 4, 30)
+	mm = np.linspace(9, 12, 12)
+	r = np.random.RandomState(1)
+	L = L_vs_z_m_polynomial_fn(p, zz, mm) + 0.05 * r.randn(30, 12)
+	L_err = 0.05 * (1 + r.rand(30, 12))
+	L[3,4] = np.nan
+	weights = np.where(np.isfinite(L), 1.0 / L_err, 0.0).ravel()
+	Vm = np.vander(mm, 2, increasing = True)
+	X = np.kron(np.vander(zz, 3, increasing = True), Vm) * weights[:,None]
+	y = np.where(np.isfinite(L), L, 0.0).ravel() * weights
+	penalty = np.kron(np.eye(3), np.dot(Vm.T, Vm))
+	lams = [0.0, 5.0]
+	fits = L_vs_z_m_ridge_fit(zz, mm, L, L_err, 3, 2, lams)
+	for lam, fit in zip(lams, fits):
+		expected = np.linalg.solve(np.dot(X.T, X) + lam * penalty, np.dot(X.T, y))
+		assert np.allclose(polynomial_coefficients(fit).ravel(), expected, rtol = 1e-8, atol = 1e-10)
@@ -0,0 +1,172 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import power_law_fits
+from power_law_fits import power_law_design_matrix
+from power_law_fits import design_power_law_fitter
+
+def training_set(n=200, seed=0):
+    ''' Synthetic L_IR(z, a_hat_AGN, UVJ) with 5% errors and an irrelevant stellar_mass '''
+    r = np.random.RandomState(seed)
+    z = r.uniform(0.2, 3, n)
+    features = {'stellar_mass': 10**r.uniform(9.5, 11.5, n), 'a_hat_AGN': 10**r.uniform(-1, 0.5, n), 'UVJ': 10**r.uniform(0, 1, n)}
+    lir = 10**(9.5 + 1.8 * np.log10(z) + 0.3 * np.log10(features['a_hat_AGN']) + 0.2 * np.log10(features['UVJ']))
+    lir *= 1 + 0.05 * r.randn(n)
+    return z, lir, features, 0.05 * lir
+
+def test_design_residual_and_fit_match_variable_power_law():
+    from power_law_fits import fit_design_power_law
+    from power_law_fits import fit_design_power_law_jacobian
+    from power_law_fits import find_variable_power_law_fit
+    from power_law_fits import fast_variable_power_law_fitter
+    z, lir, features, err = training_set()
+    features = {'a_hat_AGN': features['a_hat_AGN']}
+    names, X = power_law_design_matrix(z, features)
+    #The original fitters only run without covar (covar != None fails on arrays)
+    old = fast_variable_power_law_fitter(z, lir, {'a_hat_AGN': {'a_hat_AGN': features['a_hat_AGN']}})
+    new = design_power_law_fitter(z, lir, features)
+    for name in names:
+        assert abs(new.params[name].value - old.params[name].value) < 1e-4
+    p = new.params
+    assert np.allclose(fit_design_power_law(p, names, X, lir),
+        find_variable_power_law_fit(p, z, lir, feature1={'a_hat_AGN': features['a_hat_AGN']}))
+    p = design_power_law_fitter(z, lir, features, covar=err).params
+
+    #Dfun columns follow Parameters order, not design column order
+    numeric = []
+    for name in p:
+        hi, lo = p.copy(), p.copy()
+        hi[name].value += 1e-7
+        lo[name].value -= 1e-7
+        numeric.append((fit_design_power_law(hi, names, X, lir, err) - fit_design_power_law(lo, names, X, lir, err)) / 2e-7)
+    assert np.allclose(fit_design_power_law_jacobian(p, names, X, lir, err), np.transpose(numeric), rtol=1e-4, atol=1e-6)
+
+class Attributes:
+    pass
+
+def test_fast_build_training_set_matches_build_training_set(monkeypatch):
+    from utils import clean_args
+    monkeypatch.setattr(power_law_fits, 'completeness_flag_neural_net',
+        lambda z, m, sfg=1, completeness_cut=0.5: (np.array(m) * 0.1 + np.array(z) * 0.05 + 0.1 * sfg) >= completeness_cut)
+    r = np.random.RandomState(0)
+    n = 3000
+    db = Attributes()
+    db.table = pd.DataFrame({'ID': np.arange(n), 'LMASS': r.uniform(9, 12, n), 'lage': r.uniform(8, 10, n), 'F_ratio': r.uniform(0, 1, n)})
+    db.table.loc[r.rand(n) < 0.05, 'lage'] = -99.9
+    db.table.loc[r.rand(n) < 0.02, 'F_ratio'] = np.nan
+    znodes = [0.5, 1., 2., 3.]
+    mnodes = [9., 10., 11., 12.]
+    knodes = ['qt', 'sf']
+    stacked = Attributes()
+    stacked.bin_ids = {}
+    for k in knodes:
+        for im in range(3):
+            for iz in range(3):
+                arg = clean_args('z_{:.2f}-{:.2f}__m_{:.2f}-{:.2f}_{}'.format(znodes[iz], znodes[iz+1], mnodes[im], mnodes[im+1], k))
+                stacked.bin_ids[arg] = list(r.choice(n + 100, r.randint(0, 400), replace=False))
+    Y = {'lir': dict((arg, np.array([r.rand()])) for arg in stacked.bin_ids), 'Y_err': dict((arg, r.rand()) for arg in stacked.bin_ids)}
+    features = ['LMASS', 'lage', 'F_ratio']
+    slow = power_law_fits.build_training_set(db, stacked, features, znodes, mnodes, knodes, Y_dict=Y)
+    fast = power_law_fits.fast_build_training_set(db, stacked, features, znodes, mnodes, knodes, Y_dict=Y)
+    assert sorted(slow.keys()) == sorted(fast.keys())
+    for key in slow:
+        assert len(slow[key]) > 0
+        assert np.allclose(np.array(slow[key], dtype=float), np.array(fast[key], dtype=float), equal_nan=True)
+
+def test_resampling_is_reproducible_and_parallel_matches_serial():
+    from power_law_fits import power_law_resampling
+    z, lir, features, err = training_set(n=60)
+    features = {'a_hat_AGN': features['a_hat_AGN']}
+    serial = power_law_resampling(z, lir, features, covar=err, nsamples=20, seed=1)
+    parallel = power_law_resampling(z, lir, features, covar=err, nsamples=20, seed=1, nproc=2)
+    assert np.shape(serial['samples']) == (20, 4)
+    assert np.allclose(serial['samples'], parallel['samples'])
+    jackknife = power_law_resampling(z, lir, features, covar=err, method='jackknife')
+    assert np.shape(jackknife['samples']) == (60, 4)
+    assert np.all(jackknife['std'] > 0)
+
+def test_feature_selection_prefers_the_generating_features():
+    from power_law_fits import power_law_feature_selection
+    z, lir, features, err = training_set()
+    feature_dict = dict(features, z_peak=z, Y_val=lir, Y_err=err)
+    table = power_law_feature_selection(feature_dict, evolving_slope=False, seed=0)
+    assert len(table) == 8
+    assert sorted(table['features'][0]) == ['UVJ', 'a_hat_AGN']
+    forward = power_law_feature_selection(feature_dict, method='forward', evolving_slope=False, seed=0)
+    assert sorted(forward['features'][0]) == ['UVJ', 'a_hat_AGN']
+
+def test_catalog_prediction_matches_design_matrix_for_csv_and_npy():
+    from power_law_fits import predict_catalog_power_law
+    z, lir, features, err = training_set()
+    m = design_power_law_fitter(z, lir, features, covar=err, evolving_slope=False)
+    r = np.random.RandomState(1)
+    n = 2500
+    catalog = pd.DataFrame({'ID': np.arange(n), 'z_peak': r.uniform(0.2, 3, n), 'LMASS': r.uniform(9.5, 11.5, n),
+        'a_hat_AGN': r.uniform(-1, 0.5, n), 'UVJ': 10**r.uniform(0, 1, n), 'unused': r.rand(n)})
+    names, X = power_law_design_matrix(catalog['z_peak'].values, {'stellar_mass': 10**catalog['LMASS'].values,
+        'a_hat_AGN': 10**catalog['a_hat_AGN'].values, 'UVJ': catalog['UVJ'].values})
+    expected = np.dot(X, [m.params[name].value for name in names])
+
+    path = tempfile.mkdtemp()
+    catalog.to_csv(os.path.join(path, 'catalog.csv'), index=False)
+    predict_catalog_power_law(m, os.path.join(path, 'catalog.csv'), os.path.join(path, 'predicted.csv'), chunk_size=700)
+    predicted = pd.read_csv(os.path.join(path, 'predicted.csv'))
+    assert list(predicted.columns) == ['ID', 'log_LIR', 'SFR']
+    assert np.array_equal(predicted['ID'].values, catalog['ID'].values)
+    assert np.allclose(predicted['log_LIR'].values, expected)
+
+    np.save(os.path.join(path, 'catalog.npy'), catalog.to_records(index=False))
+    out = predict_catalog_power_law(m, np.load(os.path.join(path, 'catalog.npy'), mmap_mode='r'),
+        os.path.join(path, 'predicted.npy'), chunk_size=700)
+    assert np.allclose(np.load(out)['log_LIR'], expected)
+
+class FailingPool:
+    ''' Stands in for multiprocessing.Pool: records close/join, and map raises like a failed worker '''
+    events = []
+
+    def __init__(self, *args, **kwargs):
+        FailingPool.events.append('open')
+
+    def map(self, *args, **kwargs):
+        raise RuntimeError('refit failed')
+
+    def close(self):
+        FailingPool.events.append('close')
+
+    def join(self):
+        FailingPool.events.append('join')
+
+def test_resampling_pool_is_closed_when_a_refit_fails(monkeypatch):
+    from power_law_fits import power_law_resampling
+    monkeypatch.setattr(power_law_fits, 'Pool', FailingPool)
+    FailingPool.events = []
+    z, lir, features, err = training_set(n=20)
+    try:
+        power_law_resampling(z, lir, features, covar=err, nsamples=4, seed=1, nproc=2)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    assert FailingPool.events == ['open', 'close', 'join']
+
+def test_feature_selection_closes_its_pool_and_checks_method_first(monkeypatch):
+    from power_law_fits import power_law_feature_selection
+    monkeypatch.setattr(power_law_fits, 'Pool', FailingPool)
+    z, lir, features, err = training_set(n=20)
+    feature_dict = dict(features, z_peak=z, Y_val=lir, Y_err=err)
+    FailingPool.events = []
+    try:
+        power_law_feature_selection(feature_dict, method='sideways', nproc=2)
+    except ValueError:
+        pass
+    else:
+        assert False
+    assert FailingPool.events == []
+    try:
+        power_law_feature_selection(feature_dict, method='forward', nproc=2)
+    except RuntimeError:
+        pass
+    else:
+        assert False
+    assert FailingPool.events == ['open', 'close', 'join']
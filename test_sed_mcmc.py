@@ -0,0 +1,43 @@
+import os
+import tempfile
+import numpy as np
+from utils import greybody_kernel
+from sed_mcmc import SedSampler
+
+c = 299792458.0 # m/s
+
+wavelengths = np.array([100., 160., 250., 350., 500.])
+
+def sampler():
+    model = greybody_kernel(np.array([1e-38, 3e-38]), np.array([12., 20.]), c * 1.e6 / wavelengths, 1.8, 2.0)
+    return SedSampler(wavelengths, model, 0.05 * model, nwalkers=8, seed=3)
+
+def test_resume_matches_uninterrupted_run():
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'chain.npz')
+    reference = sampler()
+    reference.run(30)
+
+    first = sampler()
+    first.run(20, checkpoint=checkpoint, checkpoint_every=10)
+    resumed = sampler()
+    resumed.run(30, checkpoint=checkpoint, checkpoint_every=10)
+    assert resumed.iterations == 30
+    assert np.array_equal(resumed.chain, reference.chain)
+
+    again = sampler()
+    again.run(30, checkpoint=checkpoint)
+    assert again.iterations == 30
+    assert np.array_equal(again.chain, reference.chain)
+
+def test_bin_with_negative_amplitude_starts_finite_and_mixes():
+    model = greybody_kernel(np.array([1e-38, 3e-38]), np.array([12., 20.]), c * 1.e6 / wavelengths, 1.8, 2.0)
+    sigma = 0.05 * model
+    fluxes = model.copy()
+    fluxes[1] = -0.2 * model[1]
+    sampler = SedSampler(wavelengths, fluxes, sigma, nwalkers=8, seed=3)
+    sampler.initialize()
+    assert np.all(np.isfinite(sampler.position))
+    assert np.all(np.isfinite(sampler.lnprob))
+    sampler.run(50)
+    assert np.all(sampler.acceptance_fraction()[1] > 0)
+    assert np.all(np.isfinite(sampler.percentiles()))
@@ -0,0 +1,34 @@
+import numpy as np
+from utils import greybody_kernel
+from sed_templates import SedTemplateGrid
+
+c = 299792458.0 # m/s
+
+wavelengths = np.array([100., 160., 250., 350., 500.])
+
+def test_sed_matches_kernel():
+    grid = SedTemplateGrid(wavelengths, betas=[1.5, 1.8], alphas=[2.0], cpath=None)
+    A = 10**np.random.RandomState(0).uniform(-39, -37, 50)
+    T = np.random.RandomState(1).uniform(5, 60, 50)
+    exact = greybody_kernel(A, T, c * 1.e6 / wavelengths, 1.8, 2.0)
+    assert np.allclose(grid.sed(A, T, wavelengths, 1.8, 2.0), exact, rtol=grid.max_error * 1.01, atol=0)
+
+def test_sed_per_galaxy_beta_dtype_and_out():
+    grid = SedTemplateGrid(wavelengths, betas=[1.5, 1.8], alphas=[2.0], cpath=None)
+    A = np.ones(6) * 1e-38
+    T = np.linspace(10, 40, 6)
+    betas = np.array([1.5, 1.8, 1.5, 1.8, 1.8, 1.5])
+    out = np.zeros([6, len(wavelengths)], dtype=np.float32)
+    sed = grid.sed(A, T, wavelengths, betas, 2.0, dtype=np.float32, out=out)
+    assert sed is out
+    for beta in [1.5, 1.8]:
+        rows = betas == beta
+        assert np.allclose(out[rows], grid.sed(A[rows], T[rows], wavelengths, beta, 2.0), rtol=1e-6)
+
+def test_sed_rejects_off_grid_beta():
+    grid = SedTemplateGrid(wavelengths, betas=[1.8], alphas=[2.0], cpath=None)
+    try:
+        grid.sed(1e-38, 20., wavelengths, [1.8, 2.0], 2.0)
+    except ValueError:
+        return
+    assert False
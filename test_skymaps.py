@@ -0,0 +1,102 @@
+import os
+import tempfile
+import numpy as np
+from astropy.io import fits
+from skymaps import Skymaps
+
+def make_maps(path, n=200, pix=6.0, fwhm=18.0, beam_pix=None, seed=0):
+	''' SPIRE-like map file (signal and noise in extensions 1 and 2) and a Gaussian beam file '''
+	r = np.random.RandomState(seed)
+	cmap = r.randn(n, n) * 0.01
+	for k in range(100):
+		i, j = r.randint(10, n - 10, 2)
+		cmap[i-1:i+2,j-1:j+2] += r.rand() * 0.2
+	cmap[:5,:5] = np.nan
+	noise = np.abs(r.randn(n, n)) * 0.01 + 0.005
+	hd = fits.Header()
+	hd['CDELT1'] = -pix / 3600.
+	hd['CDELT2'] = pix / 3600.
+	fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(cmap.astype('>f4'), header=hd),
+		fits.ImageHDU(noise.astype('>f4'), header=hd)]).writeto(path + '_map.fits')
+	bp = pix if beam_pix is None else beam_pix
+	x = np.arange(-25, 26) * bp
+	xx, yy = np.meshgrid(x, x)
+	sig = fwhm / 2.355
+	hb = fits.Header()
+	hb['CDELT1'] = -bp / 3600.
+	hb['CDELT2'] = bp / 3600.
+	fits.PrimaryHDU(np.exp(-0.5 * (xx**2 + yy**2) / sig**2), header=hb).writeto(path + '_beam.fits')
+	return path + '_map.fits', path + '_beam.fits'
+
+def test_lazy_mode_matches_default_mode():
+	file_map, file_beam = make_maps(os.path.join(tempfile.mkdtemp(), 'band'))
+	for beam_area in [1.0, 2e-8]:
+		default = Skymaps(file_map, file_map, file_beam, beam_area=beam_area, silent=True)
+		lazy = Skymaps(file_map, file_map, file_beam, beam_area=beam_area, lazy=True)
+		for tile_default, tile_lazy in zip(default.tiles(tile_size=64, halo=5), lazy.tiles(tile_size=64, halo=5)):
+			assert np.array_equal(tile_lazy.map, tile_default.map)
+			assert np.array_equal(tile_lazy.noise, tile_default.noise)
+		assert lazy.map_peak == default.map_peak
+		assert np.max(lazy.map) == 1.0
+		assert np.array_equal(lazy.map, default.map)
+		assert np.array_equal(lazy.noise, default.noise)
+		assert lazy.rms == default.rms
+
+def test_beam_solid_angle_of_resampled_beam():
+	from skymaps import SkymapCollection
+	path = tempfile.mkdtemp()
+	file_map, file_beam = make_maps(os.path.join(path, 'band'), pix=12., fwhm=36., beam_pix=6.)
+	bands = {'500': {'file_map': file_map, 'file_noise': file_map, 'psf': file_beam, 'wavelength': 500.}}
+	for kwargs in [{}, {'cpath': path}, {'cpath': path}]:
+		collection = SkymapCollection(bands, **kwargs)
+		assert np.max(collection['500'].psf) < 0.97
+		omega = np.pi / (4. * np.log(2.)) * (36. / 3600. * np.pi / 180.)**2
+		assert abs(collection.beam_solid_angle['500'] / omega - 1.) < 0.01
+
+def test_lazy_cache_writes_map_only_when_accessed():
+	path = tempfile.mkdtemp()
+	file_map, file_beam = make_maps(os.path.join(path, 'band'))
+	reference = Skymaps(file_map, file_map, file_beam, lazy=True)
+	first = Skymaps(file_map, file_map, file_beam, lazy=True, cpath=path)
+	assert os.path.exists(os.path.join(first.cache_dir, 'scalars.npz'))
+	assert not os.path.exists(os.path.join(first.cache_dir, 'map.npy'))
+	assert np.array_equal(first.map, reference.map)
+	assert os.path.exists(os.path.join(first.cache_dir, 'map.npy'))
+	assert not os.path.exists(os.path.join(first.cache_dir, 'noise.npy'))
+	rms = first.rms
+
+	second = Skymaps(file_map, file_map, file_beam, lazy=True, cpath=path)
+	assert isinstance(second.__dict__['map'], np.memmap)
+	assert second.__dict__['rms'] == rms
+	assert second.__dict__['map_peak'] == first.map_peak
+	assert np.array_equal(second.noise, reference.noise)
+
+	third = Skymaps(file_map, file_map, file_beam, lazy=True, cpath=path)
+	assert 'raw_map' not in third.__dict__
+	assert np.array_equal(third.map, reference.map)
+	assert np.array_equal(third.noise, reference.noise)
+
+def test_tiles_stitch_back_to_the_map():
+	from skymaps import stitch_tiles
+	file_map, file_beam = make_maps(os.path.join(tempfile.mkdtemp(), 'band'), n=130)
+	for lazy in [False, True]:
+		skymap = Skymaps(file_map, file_map, file_beam, lazy=lazy, silent=True)
+		tiles = list(skymap.tiles(tile_size=50, halo=7))
+		assert len(tiles) == 9
+		assert np.shape(tiles[4].map) == (64, 64)
+		assert np.array_equal(stitch_tiles(((tile, tile.map) for tile in tiles), skymap.map_shape()), skymap.map)
+		assert np.array_equal(stitch_tiles(((tile, tile.mask) for tile in tiles), skymap.map_shape(), dtype=bool), skymap.map != 0)
+
+def test_resampled_beam_conserves_integral_and_is_cached():
+	from skymaps import resample_beam, resampled_beams
+	path = tempfile.mkdtemp()
+	file_map, file_beam = make_maps(os.path.join(path, 'band'), pix=12., fwhm=36., beam_pix=6.)
+	beam = fits.getdata(file_beam)
+	kern = resample_beam(beam, 6., 12.)
+	assert np.shape(kern)[0] % 2 == 1
+	assert np.unravel_index(np.argmax(kern), np.shape(kern)) == (np.shape(kern)[0] // 2, np.shape(kern)[1] // 2)
+	assert abs(np.sum(kern) * 12.**2 / (np.sum(beam) * 6.**2) - 1.) < 1e-12
+	resampled_beams.clear()
+	skymap = Skymaps(file_map, file_map, file_beam, silent=True, cpath=path)
+	assert np.allclose(skymap.psf, kern)
+	assert len([f for f in os.listdir(path) if f.startswith('beam_')]) == 1
@@ -0,0 +1,174 @@
+import numpy as np
+from utils import greybody_kernel
+from utils import fast_Lir_array
+from utils import luminosity_conversion
+
+c = 299792458.0 # m/s
+
+def Lir_direct(A, T, zin, betain=1.8, alphain=2.0):
+  nu = c * 1.e6 / np.linspace(8., 1000., 9920)
+  dnu = np.append(nu[0] - nu[1], nu[:-1] - nu[1:])
+  return A * np.sum(greybody_kernel(1.0, T, nu, betain, alphain) * dnu) * luminosity_conversion(zin)
+
+def test_fast_Lir_array_broadcasts_array_A_with_scalar_T():
+  Lir = fast_Lir_array(np.ones(3) * 3e-35, 20., [1, 1.5, 2])
+  assert np.shape(Lir) == (3,)
+  for i, z in enumerate([1, 1.5, 2]):
+    assert np.allclose(Lir[i], Lir_direct(3e-35, 20., z), rtol=1e-12)
+
+def test_fast_Lir_array_scalar_and_arrays():
+  assert np.shape(fast_Lir_array(3e-35, 20., 1.0)) == (1,)
+  T = np.array([10., 20., 40.])
+  Lir = fast_Lir_array(3e-35, T, 1.0, betain=[1.5, 1.8, 2.0])
+  for i, beta in enumerate([1.5, 1.8, 2.0]):
+    assert np.allclose(Lir[i], Lir_direct(3e-35, T[i], 1.0, beta), rtol=1e-12)
+
+def test_luminosity_distance_matches_astropy_inside_and_outside_table():
+  from astropy.cosmology import Planck15
+  from utils import luminosity_distance
+  z = np.array([1e-5, 0.01, 0.5, 3.0, 19.9, 25.0])
+  assert np.allclose(luminosity_distance(z), Planck15.luminosity_distance(z).value, rtol=1e-9)
+  assert np.allclose(luminosity_distance(30.0), Planck15.luminosity_distance(30.0).value, rtol=1e-12)
+  assert np.allclose(luminosity_distance(1.0), Planck15.luminosity_distance(1.0).value, rtol=1e-9)
+
+def test_luminosity_distance_table_per_range():
+  from astropy.cosmology import Planck15
+  from utils import luminosity_distance
+  from utils import luminosity_distance_tables
+  luminosity_distance(1.0)
+  luminosity_distance(1.0, z_min=0.5, z_max=2.0, nz=50)
+  assert (Planck15, 0.5, 2.0, 50) in luminosity_distance_tables
+  assert luminosity_distance_tables[Planck15, 0.5, 2.0, 50]['z_max'] == 2.0
+
+def test_T_joint_fitter_survives_a_bin_with_negative_amplitude():
+  from utils import T_joint_fitter
+  from utils import fast_sed_batch_fitter
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  zed = np.array([0.5, 1.0, 1.5, 2.0, 2.5])
+  T_rf = 27. * ((1 + zed) / 2.)**0.4
+  A = np.array([3e-38, 2e-38, 1.5e-38, 1e-38, 1e-40])
+  fluxes = greybody_kernel(A, T_rf / (1 + zed), c * 1.e6 / wavelengths, 1.8, 2.0)
+  sigma = 0.05 * np.max(fluxes, axis=1)[:,None] * np.ones_like(fluxes)
+  sigma[-1] = 0.05 * np.max(fluxes)
+  fluxes[-1] = -np.abs(fluxes[-1]) - sigma[-1] * np.array([0.3, 0.8, 1.2, 0.5, 0.2])
+  assert fast_sed_batch_fitter(wavelengths, fluxes, sigma)['A'][-1] <= 0
+  m = T_joint_fitter(wavelengths, fluxes, sigma, zed)
+  assert np.isfinite(m['T_0'].value) and np.isfinite(m['epsilon_T'].value)
+  assert abs(m['T_0'].value - 27.) < 1.
+  for i in range(4):
+    assert np.isfinite(m['A_'+str(i)].value)
+
+def sed_reference(A, T, nu_in, betain, alphain):
+  #The per-function greybody that fast_sed used before greybody_kernel
+  from utils import black
+  ng = np.size(A)
+  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
+  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
+  K = base * 10.0**expo
+  w_div = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain) / (np.exp(3.0 + betain + alphain) - 1.0)
+  nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
+  graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
+  powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
+  ind = np.where(nu_in >= np.reshape(nu_cut,(ng,1)))
+  graybody[ind] = powerlaw[ind]
+  return graybody
+
+def test_greybody_kernel_matches_reference_and_float32():
+  nu = c * 1.e6 / np.array([24., 70., 100., 160., 250., 350., 500., 850.])
+  r = np.random.RandomState(0)
+  A = 10**r.uniform(-39, -35, 40)
+  T = r.uniform(5., 80., 40)
+  exact = sed_reference(A, T, nu, 1.8 * np.ones(40), 2.0 * np.ones(40))
+  assert np.allclose(greybody_kernel(A, T, nu, 1.8, 2.0), exact, rtol=1e-3, atol=0)
+  out = np.zeros([40, len(nu)], dtype=np.float32)
+  assert greybody_kernel(A, T, nu, 1.8, 2.0, dtype=np.float32, out=out) is out
+  assert np.allclose(out, exact, rtol=1e-3, atol=0)
+
+def test_profile_fitter_recovers_noiseless_sed():
+  from utils import fast_sed_fitter
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  fluxes = greybody_kernel(2e-38, 14., c * 1.e6 / wavelengths, 1.8, 2.0)[0]
+  m = fast_sed_fitter(wavelengths, fluxes, 0.05 * fluxes, profile=True)
+  assert abs(m['T_observed'].value / 14. - 1.) < 1e-4
+  assert abs(m['A'].value / 2e-38 - 1.) < 1e-3
+
+def test_batch_fitter_matches_profile_fitter_per_bin():
+  from utils import fast_sed_batch_fitter
+  from utils import fast_sed_profile_fitter
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  r = np.random.RandomState(2)
+  A = 10**r.uniform(-39, -37, 6)
+  T = r.uniform(8., 40., 6)
+  model = greybody_kernel(A, T, c * 1.e6 / wavelengths, 1.8, 2.0)
+  sigma = 0.05 * model
+  fluxes = model + sigma * r.randn(6, 5)
+  fit = fast_sed_batch_fitter(wavelengths, fluxes, sigma)
+  assert np.all(fit['converged'])
+  for i in range(6):
+    m = fast_sed_profile_fitter(wavelengths, fluxes[i], sigma[i], nrefine=8)
+    assert abs(fit['T_observed'][i] / m['T_observed'].value - 1.) < 1e-4
+    assert abs(fit['A'][i] / m['A'].value - 1.) < 1e-3
+  full = fast_sed_batch_fitter(wavelengths, fluxes, np.array([np.diag(s**2) for s in sigma]))
+  assert np.allclose(full['T_observed'], fit['T_observed'], rtol=1e-6)
+
+def numerical_jacobian(residual, p, names, *args):
+  columns = []
+  for name in names:
+    p_hi, p_lo = p.copy(), p.copy()
+    h = 1e-6 * abs(p[name].value)
+    p_hi[name].value += h
+    p_lo[name].value -= h
+    columns.append(np.ravel(residual(p_hi, *args) - residual(p_lo, *args)) / (2. * h))
+  return np.transpose(columns)
+
+def test_sed_jacobians_match_finite_differences():
+  from lmfit import Parameters
+  from utils import find_sed_min, find_sed_jacobian, find_double_sed_min, find_double_sed_jacobian
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  fluxes = np.zeros(5)
+  covar = np.linspace(0.5, 1.5, 5)
+  p = Parameters()
+  p.add('A', value = 2e-38, vary = True)
+  p.add('T_observed', value = 14., vary = True)
+  p.add('beta', value = 1.8, vary = False)
+  p.add('alpha', value = 2.0, vary = False)
+  analytic = find_sed_jacobian(p, wavelengths, fluxes, covar)
+  numeric = numerical_jacobian(find_sed_min, p, ['A', 'T_observed'], wavelengths, fluxes, covar)
+  assert np.allclose(analytic, numeric, rtol=1e-5)
+
+  p = Parameters()
+  p.add('A_hot', value = 1e-40, vary = True)
+  p.add('A_cold', value = 1e-37, vary = True)
+  p.add('T_hot', value = 30., vary = True)
+  p.add('T_cold', value = 12., vary = True)
+  p.add('beta', value = 1.8, vary = False)
+  p.add('alpha', value = 2.0, vary = False)
+  analytic = find_double_sed_jacobian(p, wavelengths, fluxes, covar)
+  numeric = numerical_jacobian(find_double_sed_min, p, ['A_hot', 'A_cold', 'T_hot', 'T_cold'], wavelengths, fluxes, covar)
+  assert np.allclose(analytic, numeric, rtol=1e-5)
+
+def test_double_sed_linear_fitter_matches_nnls():
+  from scipy.optimize import nnls
+  from utils import fast_double_sed_linear_fitter
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  design = greybody_kernel(1.0, [30., 15.], c * 1.e6 / wavelengths, 1.8, 2.0).T
+  r = np.random.RandomState(4)
+  amplitudes = np.array([[1e-40, 1e-37], [0., 1e-37], [1e-40, 0.], [-1e-40, 1e-37], [1e-40, -1e-37]])
+  fluxes = np.dot(amplitudes, design.T)
+  sigma = 0.1 * np.max(np.abs(fluxes), axis=1)[:,None] * (1. + r.rand(5, 5))
+  fluxes += sigma * r.randn(5, 5)
+  fit = fast_double_sed_linear_fitter(wavelengths, fluxes, sigma, T_cold=15., T_hot=30.)
+  for i in range(5):
+    x, rnorm = nnls(design / sigma[i][:,None], fluxes[i] / sigma[i])
+    assert np.allclose([fit['A_hot'][i], fit['A_cold'][i]], x, rtol=1e-6, atol=1e-12 * np.max(x))
+    assert np.allclose(fit['chi2'][i], rnorm**2, rtol=1e-6)
+
+def test_batch_fitter_reports_stalled_bins_as_not_converged():
+  from utils import fast_sed_batch_fitter
+  wavelengths = np.array([100., 160., 250., 350., 500.])
+  model = greybody_kernel([1e-38, 2e-38], [12., 20.], c * 1.e6 / wavelengths, 1.8, 2.0)
+  fluxes = model.copy()
+  fluxes[1,2] = np.nan
+  fit = fast_sed_batch_fitter(wavelengths, fluxes, 0.05 * model)
+  assert fit['converged'][0] and not fit['stalled'][0]
+  assert fit['stalled'][1] and not fit['converged'][1]
@@ -9,6 +9,9 @@ from astropy.cosmology import Planck15 as cosmo
 import astropy.units as u
 from scipy.ndimage.filters import gaussian_filter
 from scipy.optimize import curve_fit
+from scipy.optimize import least_squares
+from scipy import sparse
+from scipy.interpolate import CubicSpline
 import scipy.io
 from scipy import fftpack
 from lmfit import Parameters, minimize, fit_report
@@ -27,6 +30,10 @@ h = 6.62607004e-34 #m2 kg / s  #4.13e-15 #eV/s
 k = 1.38064852e-23 #m2 kg s-2 K-1 8.617e-5 #eV/K
 gc.enable()
 
+double_sed_designs = {}
+lir_quadratures = {}
+luminosity_distance_tables = {}
+
 ## A
 
 def alex_power_spec(map1, map2=None, deltal = 1, pixsize = 5.0):
@@ -265,62 +272,36 @@ def dist_idl(n1,m1=None):
 
 ## F
 def fast_Lir(m,zin): #Tin,betain,alphain,z):
-  '''I dont know how to do this yet'''
-  wavelength_range = np.linspace(8.,1000.,10.*992.)
-  model_sed = fast_sed(m,wavelength_range)
+  '''Rest-frame L_IR (8-1000 micron) of fast_sed parameters m at redshift zin, see fast_Lir_array'''
+  v = m.valuesdict()
+  return fast_Lir_array(v['A'], v['T_observed'], zin, v['beta'], v['alpha'])
+
+def fast_double_Lir(m,zin): #Tin,betain,alphain,z):
+  '''[L_IR hot, L_IR cold] of fast_double_sed parameters m at redshift zin, see fast_Lir_array'''
+  v = m.valuesdict()
+  Lrf_hot = fast_Lir_array(v['A_hot'], v['T_hot'], zin, v['beta'], v['alpha'])
+  Lrf_cold = fast_Lir_array(v['A_cold'], v['T_cold'], zin, v['beta'], v['alpha'])
+  return [Lrf_hot, Lrf_cold]
 
-  nu_in = c * 1.e6 / wavelength_range
-  ns = len(nu_in)
+def fast_Lir_array(A, T, zin, betain=1.8, alphain=2.0, chunk_size=1000):
+  ''' L_IR for fast_sed amplitudes A, temperatures T (observed) and redshifts zin, broadcast together.
+    The 8-1000 micron frequency grid and quadrature weights are built once (lir_quadrature),
+    and since L_IR is linear in A each set of unit SEDs is integrated with one matrix-vector
+    product; rows are processed chunk_size at a time to bound the [N, 9920] SED memory.
+  '''
+  nu_in, dnu = lir_quadrature()
+  A, T, zin, betain, alphain = np.broadcast_arrays(*[np.ravel(np.asarray(x, dtype=float)) for x in (A, T, zin, betain, alphain)])
+  Lir = np.zeros(len(T))
+  for i in range(0, len(T), chunk_size):
+    sl = slice(i, i + chunk_size)
+    Lir[sl] = np.dot(greybody_kernel(1.0, T[sl], nu_in, betain[sl], alphain[sl]), dnu)
+  Lir *= A
 
-  dnu = nu_in[0:ns-1] - nu_in[1:ns]
-  dnu = np.append(dnu[0],dnu)
-  Lir = np.sum(model_sed * dnu, axis=1)
-  conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
+  conversion = luminosity_conversion(zin) # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
 
   Lrf = Lir * conversion # Jy x Hz
   return Lrf
 
-def fast_double_Lir(m,zin): #Tin,betain,alphain,z):
-  '''I dont know how to do this yet'''
-  wavelength_range = np.linspace(8.,1000.,10.*992.)
-
-  v = m.valuesdict()
-  betain = np.asarray(v['beta'])
-  alphain = np.asarray(v['alpha'])
-  A_hot= np.asarray(v['A_hot'])
-  A_cold= np.asarray(v['A_cold'])
-  T_hot = np.asarray(v['T_hot'])
-  T_cold = np.asarray(v['T_cold'])
-
-  #Hot
-  p_hot = Parameters()
-  p_hot.add('A', value = A_hot, vary = True)
-  p_hot.add('T_observed', value = T_hot, vary = True)
-  p_hot.add('beta', value = betain, vary = False)
-  p_hot.add('alpha', value = alphain, vary = False)
-  hot_sed = fast_sed(p_hot,wavelength_range)
-
-  #Hot
-  p_cold = Parameters()
-  p_cold.add('A', value = A_cold, vary = True)
-  p_cold.add('T_observed', value = T_cold, vary = True)
-  p_cold.add('beta', value = betain, vary = False)
-  p_cold.add('alpha', value = alphain, vary = False)
-  cold_sed = fast_sed(p_cold,wavelength_range)
-
-  nu_in = c * 1.e6 / wavelength_range
-  ns = len(nu_in)
-
-  dnu = nu_in[0:ns-1] - nu_in[1:ns]
-  dnu = np.append(dnu[0],dnu)
-  Lir_hot = np.sum(hot_sed * dnu, axis=1)
-  Lir_cold = np.sum(cold_sed * dnu, axis=1)
-  conversion = 4.0 * np.pi *(1.0E-13 * cosmo.luminosity_distance(zin) * 3.08568025E22)**2.0 / L_sun # 4 * pi * D_L^2    units are L_sun/(Jy x Hz)
-
-  Lrf_hot = Lir_hot * conversion # Jy x Hz
-  Lrf_cold = Lir_cold * conversion # Jy x Hz
-  return [Lrf_hot, Lrf_cold]
-
 def fast_variable_power_law_polynomial_fitter(redshifts, lir, additional_features = {}, covar=None):
     fit_params = Parameters()
     fit_params.add('gamma_z',value= 1.8, vary = True, min = 1.1, max=2.5)
@@ -396,7 +377,11 @@ def fast_power_law_fitter(redshifts, lir, additional_features = {}, covar=None):
     return m
 
 
-def fast_sed_fitter(wavelengths, fluxes, covar, betain = 1.8):
+def fast_sed_fitter(wavelengths, fluxes, covar, betain = 1.8, profile = False):
+  ''' profile=True solves for A analytically and searches only T_observed, see fast_sed_profile_fitter '''
+  if profile == True:
+    return fast_sed_profile_fitter(wavelengths, fluxes, covar, betain = betain)
+
   fit_params = Parameters()
   fit_params.add('A', value = 1e-32, vary = True)
   fit_params.add('T_observed', value = 24.0, vary = True, min = 0.1)
@@ -407,14 +392,157 @@ def fast_sed_fitter(wavelengths, fluxes, covar, betain = 1.8):
 
   sed_params = minimize(find_sed_min,fit_params,
     args=(np.ndarray.flatten(wavelengths),),
-    kws={'fluxes':fluxes,'covar':covar})
+    kws={'fluxes':fluxes,'covar':covar},
+    Dfun=find_sed_jacobian)
 
   m = sed_params.params
   #m = sed_params
 
   return m
 
-def fast_double_sed_fitter(wavelengths, fluxes, covar, T_cold=15.0, T_hot=30.0):
+def fast_sed_profile_fitter(wavelengths, fluxes, covar, betain = 1.8, alphain = 2.0, T_range = [1.0, 150.0], ngrid = 40, nrefine = 4):
+  ''' Fit A and T_observed of fast_sed by profiling: A enters linearly, so at each T the
+    weighted least-squares A is solved exactly and only T is searched, on a log grid that is
+    refined around the minimum nrefine times.  Returns lmfit Parameters like fast_sed_fitter,
+    with stderr from the (A, T) Fisher matrix.
+  '''
+  nu_in = c * 1.e6 / np.ndarray.flatten(np.asarray(wavelengths, dtype=float))
+  fluxes = np.ravel(fluxes)
+  if covar is None:
+    weights = np.ones(len(fluxes))
+  else:
+    weights = 1.0 / np.ravel(covar)**2
+
+  logT = np.linspace(np.log(T_range[0]), np.log(T_range[1]), ngrid)
+  for i in range(nrefine + 1):
+    A, chi2 = profile_sed_amplitude(greybody_kernel(1.0, np.exp(logT), nu_in, betain, alphain), fluxes, weights)
+    ibest = np.nanargmin(chi2)
+    logT = np.linspace(logT[max(ibest - 1, 0)], logT[min(ibest + 1, ngrid - 1)], ngrid)
+  T_best = np.exp(logT[ngrid // 2])
+
+  #Uncertainties from the Fisher matrix of (A, T), scaled by reduced chi2 as lmfit does
+  dT = 1e-4 * T_best
+  seds = greybody_kernel(1.0, T_best + np.array([-dT, 0.0, dT]), nu_in, betain, alphain)
+  A_best, chi2 = profile_sed_amplitude(seds[1], fluxes, weights)
+  jac = np.array([seds[1], A_best * (seds[2] - seds[0]) / (2.0 * dT)])
+  fisher = np.dot(jac * weights, jac.T)
+  nfree = len(fluxes) - 2
+  if nfree > 0:
+    covariance = np.linalg.inv(fisher) * chi2 / nfree
+  else:
+    covariance = np.linalg.inv(fisher)
+
+  m = Parameters()
+  m.add('A', value = A_best, vary = True)
+  m.add('T_observed', value = T_best, vary = True, min = 0.1)
+  m.add('beta', value = betain, vary = False)
+  m.add('alpha', value = alphain, vary = False)
+  m['A'].stderr = np.sqrt(covariance[0,0])
+  m['T_observed'].stderr = np.sqrt(covariance[1,1])
+
+  return m
+
+def fast_sed_batch_fitter(wavelengths, fluxes, covar, betain = 1.8, alphain = 2.0, T_range = [1.0, 150.0], ngrid = 40, niter = 50, tol = 1e-8):
+  ''' Fit fast_sed (A, T_observed) to n_bins SEDs at once.
+    fluxes is [n_bins, n_wavelengths]; covar is either the matching array of 1-sigma errors
+    (as in fast_sed_fitter) or full covariance matrices [n_bins, n_wavelengths, n_wavelengths].
+    Starts every bin from a coarse profile grid in T (see fast_sed_profile_fitter), then takes
+    damped Gauss-Newton steps for all bins together until the T steps fall below tol.
+    Returns a structured array with A, A_err, T_observed, T_observed_err, chi2, converged (the T
+    step fell below tol) and stalled (the damping blew up first, e.g. at a T_range clip bound);
+    errors are from the Fisher matrix scaled by reduced chi2, as lmfit reports them.
+  '''
+  nu_in = c * 1.e6 / np.ndarray.flatten(np.asarray(wavelengths, dtype=float))
+  fluxes = np.atleast_2d(fluxes)
+  nb, nw = np.shape(fluxes)
+  covar = np.asarray(covar, dtype=float)
+  if covar.ndim == 3:
+    precision = np.linalg.inv(covar)
+    inner = lambda x, y: np.einsum('bi,bij,bj->b', x, precision, y)
+    Pf = np.einsum('bij,bj->bi', precision, fluxes)
+    grid_num = lambda s: np.dot(Pf, s.T)
+    grid_den = lambda s: np.einsum('gi,bij,gj->bg', s, precision, s)
+  else:
+    weights = 1.0 / np.reshape(covar, (nb, nw))**2
+    inner = lambda x, y: np.sum(weights * x * y, axis=1)
+    grid_num = lambda s: np.dot(weights * fluxes, s.T)
+    grid_den = lambda s: np.dot(weights, (s**2).T)
+
+  #Starting temperatures from the profile chi2 on a coarse grid
+  T_grid = np.exp(np.linspace(np.log(T_range[0]), np.log(T_range[1]), ngrid))
+  s_grid = greybody_kernel(1.0, T_grid, nu_in, betain, alphain)
+  num = grid_num(s_grid)
+  den = grid_den(s_grid)
+  chi2_grid = inner(fluxes, fluxes)[:,None] - num**2 / den
+  ibest = np.argmin(chi2_grid, axis=1)
+  T = T_grid[ibest]
+  A = num[np.arange(nb), ibest] / den[np.arange(nb), ibest]
+
+  def normal_equations(A, T):
+    s = greybody_kernel(1.0, T, nu_in, betain, alphain)
+    d = A[:,None] * greybody_kernel_dT(1.0, T, nu_in, betain, alphain)
+    r = fluxes - A[:,None] * s
+    H = np.array([[inner(s, s), inner(s, d)], [inner(s, d), inner(d, d)]])
+    g = np.array([inner(s, r), inner(d, r)])
+    return H, g, inner(r, r)
+
+  lam = np.zeros(nb) + 1e-3
+  converged = np.zeros(nb, dtype=bool)
+  stalled = np.zeros(nb, dtype=bool)
+  H, g, chi2 = normal_equations(A, T)
+  for i in range(niter):
+    H00 = H[0,0] * (1.0 + lam)
+    H11 = H[1,1] * (1.0 + lam)
+    det = H00 * H11 - H[0,1]**2
+    dA = (H11 * g[0] - H[0,1] * g[1]) / det
+    dT = (H00 * g[1] - H[0,1] * g[0]) / det
+    A_try = A + dA
+    T_try = np.clip(T + dT, 0.5 * T_range[0], 2.0 * T_range[1])
+    H_try, g_try, chi2_try = normal_equations(A_try, T_try)
+    active = ~converged & ~stalled
+    better = (chi2_try <= chi2) & active
+    converged |= better & (np.abs(dT) < tol * T)
+    A[better] = A_try[better]
+    T[better] = T_try[better]
+    H[:,:,better] = H_try[:,:,better]
+    g[:,better] = g_try[:,better]
+    chi2[better] = chi2_try[better]
+    lam[better] *= 0.1
+    lam[active & ~better] *= 10.0
+    stalled |= ~converged & (lam > 1e10)
+    if np.all(converged | stalled):
+      break
+
+  det = H[0,0] * H[1,1] - H[0,1]**2
+  if nw > 2:
+    scale = chi2 / (nw - 2)
+  else:
+    scale = 1.0
+  fit = np.zeros(nb, dtype=[('A', 'f8'), ('A_err', 'f8'), ('T_observed', 'f8'), ('T_observed_err', 'f8'), ('chi2', 'f8'), ('converged', 'bool'), ('stalled', 'bool')])
+  fit['A'] = A
+  fit['A_err'] = np.sqrt(H[1,1] / det * scale)
+  fit['T_observed'] = T
+  fit['T_observed_err'] = np.sqrt(H[0,0] / det * scale)
+  fit['chi2'] = chi2
+  fit['converged'] = converged
+  fit['stalled'] = stalled
+
+  return fit
+
+def fast_double_sed_fitter(wavelengths, fluxes, covar, T_cold=15.0, T_hot=30.0, linear=False):
+  ''' linear=True solves for A_hot, A_cold exactly with fast_double_sed_linear_fitter (amplitudes >= 0) '''
+  if linear == True:
+    fit = fast_double_sed_linear_fitter(wavelengths, fluxes, covar, T_cold=T_cold, T_hot=T_hot)[0]
+    m = Parameters()
+    m.add('A_hot', value = fit['A_hot'], vary = True)
+    m.add('A_cold', value = fit['A_cold'], vary = True)
+    m.add('T_hot', value = T_hot, vary = False, min = 9.0, max = 150.0)
+    m.add('T_cold', value = T_cold, vary = False, min = 1.0, max = 20.0)
+    m.add('beta', value = 1.80, vary = False)
+    m.add('alpha', value = 2.0, vary = False)
+    m['A_hot'].stderr = fit['A_hot_err']
+    m['A_cold'].stderr = fit['A_cold_err']
+    return m
 
   fit_params = Parameters()
   fit_params.add('A_hot', value = 1e-40, vary = True)#, min = 0.)
@@ -428,7 +556,8 @@ def fast_double_sed_fitter(wavelengths, fluxes, covar, T_cold=15.0, T_hot=30.0):
 
   sed_params = minimize(find_double_sed_min,fit_params,
     args=(np.ndarray.flatten(wavelengths),),
-    kws={'fluxes':fluxes,'covar':covar})
+    kws={'fluxes':fluxes,'covar':covar},
+    Dfun=find_double_sed_jacobian)
 
   m = sed_params.params
   #m = sed_params
@@ -436,6 +565,55 @@ def fast_double_sed_fitter(wavelengths, fluxes, covar, T_cold=15.0, T_hot=30.0):
   return m
 
 
+def fast_double_sed_linear_fitter(wavelengths, fluxes, covar, T_cold=15.0, T_hot=30.0, betain=1.8, alphain=2.0):
+  ''' Non-negative least squares for A_hot, A_cold of fast_double_sed at fixed T_hot, T_cold,
+    for [n_bins, n_wavelengths] fluxes and matching 1-sigma errors at once.
+    The model is linear in the amplitudes, so each bin is an exact 2x2 solve against the
+    two-column design matrix (cached per wavelength set); where that gives a negative amplitude
+    the best single-component solution (or zero) is taken instead, which is the exact NNLS optimum.
+    Returns a structured array with A_hot, A_hot_err, A_cold, A_cold_err and chi2;
+    errors are from the 2x2 Fisher matrix scaled by reduced chi2.
+  '''
+  wavelengths = np.ndarray.flatten(np.asarray(wavelengths, dtype=float))
+  key = (tuple(wavelengths), T_hot, T_cold, betain, alphain)
+  if key not in double_sed_designs:
+    nu_in = c * 1.e6 / wavelengths
+    double_sed_designs[key] = greybody_kernel(1.0, [T_hot, T_cold], nu_in, betain, alphain)
+  design = double_sed_designs[key]
+
+  fluxes = np.atleast_2d(fluxes)
+  nb, nw = np.shape(fluxes)
+  weights = 1.0 / np.reshape(covar, (nb, nw))**2
+
+  #Normal equations for every bin: H = D W D^T, g = D W f
+  H = np.einsum('ai,bi,ni->nab', design, design, weights)
+  g = np.dot(weights * fluxes, design.T)
+  det = H[:,0,0] * H[:,1,1] - H[:,0,1]**2
+  A = np.transpose([H[:,1,1] * g[:,0] - H[:,0,1] * g[:,1], H[:,0,0] * g[:,1] - H[:,0,1] * g[:,0]]) / det[:,None]
+
+  #Active-set candidates: both free, hot only, cold only, neither
+  candidates = np.array([A,
+    np.transpose([np.clip(g[:,0] / H[:,0,0], 0, None), np.zeros(nb)]),
+    np.transpose([np.zeros(nb), np.clip(g[:,1] / H[:,1,1], 0, None)]),
+    np.zeros([nb, 2])])
+  chi2 = np.sum(weights * (fluxes - np.dot(candidates, design))**2, axis=2)
+  chi2[0, np.any(A < 0, axis=1)] = np.inf
+  best = np.argmin(chi2, axis=0)
+  A = candidates[best, np.arange(nb)]
+
+  if nw > 2:
+    scale = chi2[best, np.arange(nb)] / (nw - 2)
+  else:
+    scale = 1.0
+  fit = np.zeros(nb, dtype=[('A_hot', 'f8'), ('A_hot_err', 'f8'), ('A_cold', 'f8'), ('A_cold_err', 'f8'), ('chi2', 'f8')])
+  fit['A_hot'] = A[:,0]
+  fit['A_hot_err'] = np.sqrt(H[:,1,1] / det * scale)
+  fit['A_cold'] = A[:,1]
+  fit['A_cold_err'] = np.sqrt(H[:,0,0] / det * scale)
+  fit['chi2'] = chi2[best, np.arange(nb)]
+
+  return fit
+
 def find_variable_power_law_polynomial_fit(p, redshifts, lir, stellar_mass, feature1=None, feature2=None, feature3=None, covar = None):
 
     v = p.valuesdict()
@@ -519,12 +697,41 @@ def find_sed_min(p, wavelengths, fluxes, covar = None):
   graybody = fast_sed(p,wavelengths)
   #print p['T_observed']
   #print fluxes - graybody
-  if covar == None:
+  if covar is None:
       return (fluxes - graybody)
   else:
       return (fluxes - graybody) / covar
   #return (fluxes - graybody) # np.invert(covar) # (fluxes - graybody)
 
+def find_sed_jacobian(p, wavelengths, fluxes, covar = None):
+  ''' Analytic Jacobian of find_sed_min, passed to lmfit as Dfun.
+    One column per varying parameter (A and/or T_observed), in Parameters order.
+  '''
+  nu_in = c * 1.e6 / wavelengths
+
+  v = p.valuesdict()
+  A= np.asarray(v['A'])
+  T = np.asarray(v['T_observed'])
+  betain = np.asarray(v['beta'])
+  alphain = np.asarray(v['alpha'])
+
+  columns = []
+  for name in p:
+    if p[name].vary == False or p[name].expr != None:
+      continue
+    if name == 'A':
+      columns.append(np.ravel(greybody_kernel(1.0, T, nu_in, betain, alphain)))
+    elif name == 'T_observed':
+      columns.append(np.ravel(greybody_kernel_dT(A, T, nu_in, betain, alphain)))
+    else:
+      raise ValueError("No analytic derivative for parameter {}".format(name))
+
+  jac = -1.0 * np.transpose(columns)
+  if covar is None:
+      return jac
+  else:
+      return jac / np.reshape(covar, (-1,1))
+
 def find_double_sed_min(p, wavelengths, fluxes, covar):
 
   graybody_hot = fast_hot_sed(p,wavelengths)
@@ -533,6 +740,32 @@ def find_double_sed_min(p, wavelengths, fluxes, covar):
 
   return (fluxes - graybody) / covar
 
+def find_double_sed_jacobian(p, wavelengths, fluxes, covar):
+  ''' Analytic Jacobian of find_double_sed_min, passed to lmfit as Dfun.
+    One column per varying parameter (A_hot, A_cold, T_hot, T_cold), in Parameters order.
+  '''
+  nu_in = c * 1.e6 / wavelengths
+
+  v = p.valuesdict()
+  betain = np.asarray(v['beta'])
+  alphain = np.asarray(v['alpha'])
+
+  columns = []
+  for name in p:
+    if p[name].vary == False or p[name].expr != None:
+      continue
+    if name in ['A_hot', 'A_cold']:
+      T = np.asarray(v[name.replace('A_','T_')])
+      columns.append(np.ravel(greybody_kernel(1.0, T, nu_in, betain, alphain)))
+    elif name in ['T_hot', 'T_cold']:
+      A = np.asarray(v[name.replace('T_','A_')])
+      T = np.asarray(v[name])
+      columns.append(np.ravel(greybody_kernel_dT(A, T, nu_in, betain, alphain)))
+    else:
+      raise ValueError("No analytic derivative for parameter {}".format(name))
+
+  return -1.0 * np.transpose(columns) / np.reshape(covar, (-1,1))
+
 def fast_hot_sed(m,wavelengths):
   nu_in = c * 1.e6 / wavelengths
 
@@ -541,22 +774,8 @@ def fast_hot_sed(m,wavelengths):
   T = np.asarray(v['T_hot'])
   betain = np.asarray(v['beta'])
   alphain = np.asarray(v['alpha'])
-  ng = np.size(A)
 
-  ns = len(nu_in)
-  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-  K = base * 10.0**expo
-  w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-  w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-  w_div = w_num/w_den
-  nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-  graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-  powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-  graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
-
-  return graybody
+  return greybody_kernel(A, T, nu_in, betain, alphain)
 
 def fast_cold_sed(m,wavelengths):
   nu_in = c * 1.e6 / wavelengths
@@ -566,24 +785,11 @@ def fast_cold_sed(m,wavelengths):
   T = np.asarray(v['T_cold'])
   betain = np.asarray(v['beta'])
   alphain = np.asarray(v['alpha'])
-  ng = np.size(A)
-
-  ns = len(nu_in)
-  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-  K = base * 10.0**expo
-  w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-  w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-  w_div = w_num/w_den
-  nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
 
-  graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-  powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-  graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
+  return greybody_kernel(A, T, nu_in, betain, alphain)
 
-  return graybody
-
-def fast_double_sed(m,wavelengths):
+def fast_double_sed(m,wavelengths,template=None):
+  ''' template = sed_templates.SedTemplateGrid to interpolate instead of evaluating the greybody '''
   nu_in = c * 1.e6 / wavelengths
 
   v = m.valuesdict()
@@ -593,35 +799,18 @@ def fast_double_sed(m,wavelengths):
   T_cold = np.asarray(v['T_cold'])
   betain = np.asarray(v['beta'])
   alphain = np.asarray(v['alpha'])
-  ng_hot = np.size(A_hot)
-  ng_cold = np.size(A_cold)
 
-  ns = len(nu_in)
-  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-  K = base * 10.0**expo
-
-  #Hot
-  w_num_hot = A_hot * K * (T_hot * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-  w_den_hot = (np.exp(3.0 + betain + alphain) - 1.0)
-  w_div_hot = w_num_hot/w_den_hot
-  nu_cut_hot= (3.0 + betain + alphain) * 0.208367e11 * T_hot
-  graybody_hot = np.reshape(A_hot,(ng_hot,1)) * nu_in**np.reshape(betain,(ng_hot,1)) * black(nu_in, T_hot) / 1000.0
-  powerlaw_hot = np.reshape(w_div_hot,(ng_hot,1)) * nu_in**np.reshape(-1.0 * alphain,(ng_hot,1))
-  graybody_hot[np.where(nu_in >= np.reshape(nu_cut_hot,(ng_hot,1)))]=powerlaw_hot[np.where(nu_in >= np.reshape(nu_cut_hot,(ng_hot,1)))]
-
-  #Cold
-  w_num_cold = A_cold * K * (T_cold * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-  w_den_cold = (np.exp(3.0 + betain + alphain) - 1.0)
-  w_div_cold = w_num_cold/w_den_cold
-  nu_cut_cold = (3.0 + betain + alphain) * 0.208367e11 * T_cold
-  graybody_cold = np.reshape(A_cold,(ng_cold,1)) * nu_in**np.reshape(betain,(ng_cold,1)) * black(nu_in, T_cold) / 1000.0
-  powerlaw_cold = np.reshape(w_div_cold,(ng_cold,1)) * nu_in**np.reshape(-1.0 * alphain,(ng_cold,1))
-  graybody_cold[np.where(nu_in >= np.reshape(nu_cut_cold,(ng_cold,1)))]=powerlaw_cold[np.where(nu_in >= np.reshape(nu_cut_cold,(ng_cold,1)))]
+  if template != None:
+    graybody_hot = template.sed(A_hot, T_hot, wavelengths, betain, alphain)
+    graybody_cold = template.sed(A_cold, T_cold, wavelengths, betain, alphain)
+  else:
+    graybody_hot = greybody_kernel(A_hot, T_hot, nu_in, betain, alphain)
+    graybody_cold = greybody_kernel(A_cold, T_cold, nu_in, betain, alphain)
 
   return graybody_hot+graybody_cold
 
-def fast_sed(m,wavelengths):
+def fast_sed(m,wavelengths,dtype=np.float64,out=None,template=None):
+  ''' template = sed_templates.SedTemplateGrid to interpolate instead of evaluating the greybody '''
   nu_in = c * 1.e6 / wavelengths
 
   v = m.valuesdict()
@@ -629,22 +818,11 @@ def fast_sed(m,wavelengths):
   T = np.asarray(v['T_observed'])
   betain = np.asarray(v['beta'])
   alphain = np.asarray(v['alpha'])
-  ng = np.size(A)
 
-  ns = len(nu_in)
-  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
-  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
-  K = base * 10.0**expo
-  w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
-  w_den = (np.exp(3.0 + betain + alphain) - 1.0)
-  w_div = w_num/w_den
-  nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
-
-  graybody = np.reshape(A,(ng,1)) * nu_in**np.reshape(betain,(ng,1)) * black(nu_in, T) / 1000.0
-  powerlaw = np.reshape(w_div,(ng,1)) * nu_in**np.reshape(-1.0 * alphain,(ng,1))
-  graybody[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]=powerlaw[np.where(nu_in >= np.reshape(nu_cut,(ng,1)))]
+  if template != None:
+    return template.sed(A, T, wavelengths, betain, alphain, dtype=dtype, out=out)
 
-  return graybody
+  return greybody_kernel(A, T, nu_in, betain, alphain, dtype=dtype, out=out)
 
 def find_nearest(array,value):
     idx = (np.abs(array-value)).argmin()
@@ -711,6 +889,81 @@ def ghz_to_lambda(ghz):
   lam=c/hz * 1e6
   return lam
 
+def greybody_kernel(A, T, nu_in, betain=1.8, alphain=2.0, dtype=np.float64, out=None):
+  ''' Graybody + Wien power-law SED for N galaxies x M frequencies, in mJy.
+    A, T, betain, alphain are scalars or length-N arrays, nu_in is in Hz.
+    The two pieces are stitched at nu_cut, where they and their first
+    derivatives coincide (see invert_sed.simple_flux_from_greybody).
+    Per-galaxy coefficients are computed in float64 and frequencies are
+    scaled by their maximum, so that dtype=np.float32 does not underflow
+    for the tiny amplitudes (~1e-35) used by the fitters.
+    Pass out=[N,M] array to evaluate in place.
+  '''
+  a0 = 1.4718e-21   # 2*h*10^29/c^2
+  a1 = 4.7993e-11   # h/k
+
+  nu = np.ravel(nu_in).astype(np.float64)
+  A = np.reshape(np.asarray(A, dtype=np.float64), (-1,1))
+  T = np.reshape(np.asarray(T, dtype=np.float64), (-1,1))
+  betain = np.reshape(np.asarray(betain, dtype=np.float64), (-1,1))
+  alphain = np.reshape(np.asarray(alphain, dtype=np.float64), (-1,1))
+  ng = np.broadcast(A, T, betain, alphain).shape[0]
+  ns = len(nu)
+
+  if out is None:
+    out = np.empty([ng, ns], dtype=dtype)
+  elif np.shape(out) != (ng, ns):
+    raise ValueError("out has shape {}, expected {}".format(np.shape(out),(ng, ns)))
+
+  base = 2.0 * (6.626)**(-2.0 - betain - alphain) * (1.38)**(3. + betain + alphain) / (2.99792458)**2.0
+  expo = 34.0 * (2.0 + betain + alphain) - 23.0 * (3.0 + betain + alphain) - 16.0 + 26.0
+  K = base * 10.0**expo
+  w_num = A * K * (T * (3.0 + betain + alphain))**(3.0 + betain + alphain)
+  w_den = (np.exp(3.0 + betain + alphain) - 1.0)
+  w_div = w_num/w_den
+  nu_cut = (3.0 + betain + alphain) * 0.208367e11 * T
+
+  nu_ref = np.max(nu)
+  x = (nu / nu_ref).astype(out.dtype)
+
+  #Graybody everywhere, built in place: A * nu^beta * black(nu, T) / 1000
+  with np.errstate(over='ignore'):
+    np.multiply((a1 / T).astype(out.dtype), nu.astype(out.dtype), out=out)
+    np.expm1(out, out=out)
+    np.divide(x ** (3.0 + betain).astype(out.dtype), out, out=out)
+  np.multiply(out, (A * a0 / 1000.0 * nu_ref**(3.0 + betain)).astype(out.dtype), out=out)
+
+  #Power law only where nu >= nu_cut
+  rows, cols = np.nonzero(nu >= nu_cut)
+  if len(rows):
+    w_ref = np.broadcast_to(w_div * nu_ref**(-1.0 * alphain), (ng,1))[rows,0]
+    if np.size(alphain) == 1:
+      powerlaw = (x ** (-1.0 * alphain[0,0]).astype(out.dtype))[cols]
+    else:
+      powerlaw = x[cols] ** (-1.0 * alphain[rows,0]).astype(out.dtype)
+    out[rows, cols] = w_ref * powerlaw
+
+  return out
+
+def greybody_kernel_dT(A, T, nu_in, betain=1.8, alphain=2.0):
+  ''' Analytic dS/dT of greybody_kernel, [N,M] in mJy/K.
+    Graybody piece: S * x/(1-exp(-x)) / T with x = h*nu/(k*T); power-law piece: S * (3+beta+alpha) / T.
+    At nu_cut the derivative is taken from the same piece greybody_kernel uses there.
+  '''
+  a1 = 4.7993e-11   # h/k
+
+  nu = np.ravel(nu_in).astype(np.float64)
+  T = np.reshape(np.asarray(T, dtype=np.float64), (-1,1))
+  ba = np.reshape(3.0 + np.asarray(betain, dtype=np.float64) + np.asarray(alphain, dtype=np.float64), (-1,1))
+  nu_cut = ba * 0.208367e11 * T
+
+  x = a1 * nu / T
+  factor = x / -np.expm1(-x)
+  wien = nu >= nu_cut
+  factor[wien] = np.broadcast_to(ba, factor.shape)[wien]
+
+  return greybody_kernel(A, T, nu, betain, alphain) * factor / T
+
 ## I
 
 def idl_restore(tfname):
@@ -782,6 +1035,45 @@ def loggen(minval, maxval, npoints, linear = None):
   else:
     return 10.0 ** ( (np.log10(maxval/minval)) * points + np.log10(minval) )
 
+def luminosity_distance(zin, cosmology=cosmo, z_min=1e-4, z_max=20., nz=1000):
+  ''' Luminosity distance in Mpc (plain floats), for scalar or array zin.
+    D_L is tabulated once per cosmology (Planck15 by default, or any astropy cosmology)
+    on nz points uniform in log(z), and served from a cubic spline in log(z)-log(D_L)
+    whose coefficients are evaluated directly, avoiding astropy's per-call overhead.
+    The relative error against astropy, checked at the table midpoints when it is built,
+    is kept in luminosity_distance_tables[cosmology, z_min, z_max, nz]['max_error'] (~1e-11 for Planck15).
+    Redshifts outside [z_min, z_max] are passed to astropy directly.
+  '''
+  key = (cosmology, z_min, z_max, nz)
+  if key not in luminosity_distance_tables:
+    log_z = np.linspace(np.log(z_min), np.log(z_max), nz)
+    log_z_mid = 0.5 * (log_z[1:] + log_z[:-1])
+    spline = CubicSpline(log_z, np.log(cosmology.luminosity_distance(np.exp(log_z)).value))
+    exact = cosmology.luminosity_distance(np.exp(log_z_mid)).value
+    luminosity_distance_tables[key] = {'coefficients':spline.c, 'log_z_min':log_z[0],
+      'dlog_z':log_z[1] - log_z[0], 'z_min':z_min, 'z_max':z_max,
+      'max_error':np.max(np.abs(np.exp(spline(log_z_mid)) / exact - 1.0))}
+  table = luminosity_distance_tables[key]
+
+  z = np.asarray(zin, dtype=float)
+  inside = (z >= table['z_min']) & (z <= table['z_max'])
+  u = (np.log(np.where(inside, z, table['z_min'])) - table['log_z_min']) / table['dlog_z']
+  i = np.clip(u.astype(int), 0, table['coefficients'].shape[1] - 1)
+  t = (u - i) * table['dlog_z']
+  cs = table['coefficients'][:,i]
+  D_L = np.exp(((cs[0] * t + cs[1]) * t + cs[2]) * t + cs[3])
+  if not np.all(inside):
+    outside = ~inside
+    if np.ndim(D_L) == 0:
+      D_L = cosmology.luminosity_distance(z).value
+    else:
+      D_L[outside] = cosmology.luminosity_distance(z[outside]).value
+  return D_L
+
+def luminosity_conversion(zin, cosmology=cosmo):
+  ''' 4 * pi * D_L^2 in L_sun/(Jy x Hz), from the cached luminosity_distance '''
+  return 4.0 * np.pi *(1.0E-13 * luminosity_distance(zin, cosmology=cosmology) * 3.08568025E22)**2.0 / L_sun
+
 def L_fun(p,zed):
   '''Luminosities in log(L)'''
   v = p.valuesdict()
@@ -793,6 +1085,18 @@ def L_fit(p, zed, L, Lerr):
   lum = L_fun(p,zed)
   return (L - lum)/Lerr
 
+def lir_quadrature(lambda_min=8., lambda_max=1000., nsed=9920):
+  ''' Frequency grid (Hz) and rectangle-rule weights dnu used by fast_Lir, built once per grid '''
+  key = (lambda_min, lambda_max, nsed)
+  if key not in lir_quadratures:
+    wavelength_range = np.linspace(lambda_min, lambda_max, nsed)
+    nu_in = c * 1.e6 / wavelength_range
+    ns = len(nu_in)
+    dnu = nu_in[0:ns-1] - nu_in[1:ns]
+    dnu = np.append(dnu[0],dnu)
+    lir_quadratures[key] = (nu_in, dnu)
+  return lir_quadratures[key]
+
 ## M
 
 def main_sequence_s15(mass,redshift):
@@ -949,6 +1253,17 @@ def poly(X,C):
 
     return y
 
+def profile_sed_amplitude(seds, fluxes, weights):
+  ''' Weighted least-squares amplitude of unit-amplitude seds [..., M] to fluxes [..., M],
+    and the chi2 at that amplitude.  Leading axes broadcast, e.g. a grid of T or a batch of bins.
+  '''
+  sw = seds * weights
+  num = np.sum(sw * fluxes, axis=-1)
+  den = np.sum(sw * seds, axis=-1)
+  A = num / den
+  chi2 = np.sum(weights * (fluxes - A[...,None] * seds)**2, axis=-1)
+  return A, chi2
+
 ## R
 #def round_sig(x, sig=2):
 #  return np.round(x, sig-int(np.floor(np.log10(x)))-1)
@@ -1083,6 +1398,99 @@ def T_fit(p, zed, T, Terr):
   Temp = T_fun(p,zed)
   return (T - Temp)/Terr
 
+def T_joint_fitter(wavelengths, fluxes, covar, zed, betain = 1.8, alphain = 2.0, rest_frame = True, T_0 = None, epsilon_T = None):
+  ''' Fit T_fun (T_0, epsilon_T) and one amplitude per bin directly to n_bins stacked SEDs,
+    instead of fast_sed_fitter per bin followed by T_fit.
+    fluxes is [n_bins, n_wavelengths] at redshifts zed; covar is the matching 1-sigma errors or
+    full covariance matrices.  Bin i has T_observed = T_fun(zed_i) / (1 + zed_i), or T_fun(zed_i)
+    itself if rest_frame = False.  Amplitudes are solved as log10 A with scipy least_squares and a
+    block-sparse Jacobian (each amplitude only touches its own bin), so the cost is linear in n_bins.
+    Starting values come from fast_sed_batch_fitter unless T_0 and epsilon_T are given; bins it
+    fits with A <= 0 are left out of the temperature seed and start from |profile amplitude|.
+    Returns lmfit Parameters T_0, epsilon_T and A_0 ... A_{n_bins-1}, with stderr from the
+    Fisher matrix (2x2 Schur complement over the amplitudes) scaled by reduced chi2.
+  '''
+  z_T = 1.0
+  nu_in = c * 1.e6 / np.ndarray.flatten(np.asarray(wavelengths, dtype=float))
+  fluxes = np.atleast_2d(fluxes)
+  nb, nw = np.shape(fluxes)
+  zed = np.ravel(zed)
+  covar = np.asarray(covar, dtype=float)
+  if covar.ndim == 3:
+    whiten = np.linalg.inv(np.linalg.cholesky(covar))
+    apply_whiten = lambda x: np.einsum('bij,bj->bi', whiten, x)
+  else:
+    sigma = np.reshape(covar, (nb, nw))
+    apply_whiten = lambda x: x / sigma
+  white_fluxes = apply_whiten(fluxes)
+  frame = 1.0 / (1.0 + zed) if rest_frame else np.ones(nb)
+  log_evolution = np.log((1.0 + zed) / (1.0 + z_T))
+
+  batch = fast_sed_batch_fitter(wavelengths, fluxes, covar, betain, alphain)
+  good = np.isfinite(batch['A']) & (batch['A'] > 0) & np.isfinite(batch['T_observed']) & (batch['T_observed'] > 0)
+  if T_0 == None or epsilon_T == None:
+    w = np.where(good, (batch['T_observed'] / batch['T_observed_err'])**2, 0.0)
+    w[~np.isfinite(w)] = 0.0
+    log_T = np.log(np.where(good, batch['T_observed'], 1.0) / frame)
+    slope, intercept = np.polyfit(log_evolution, log_T, 1, w = np.sqrt(w))
+    T_0 = np.exp(intercept)
+    epsilon_T = slope
+
+  #Bins the batch fit left at A <= 0 (noise-dominated) start from |profile amplitude| at the
+  #seeded temperature instead, floored so log10 A stays finite
+  A_start = np.array(batch['A'], dtype=float)
+  if not np.all(good):
+    unit = apply_whiten(greybody_kernel(np.ones(nb), T_0 * np.exp(epsilon_T * log_evolution) * frame, nu_in, betain, alphain))
+    profile = np.abs(np.sum(unit * white_fluxes, axis=1) / np.sum(unit**2, axis=1))
+    A_floor = np.min(A_start[good]) * 1e-3 if np.any(good) else np.max(profile[np.isfinite(profile)]) * 1e-3
+    A_start[~good] = np.maximum(np.where(np.isfinite(profile), profile, 0.0), A_floor)[~good]
+  x0 = np.concatenate([[T_0, epsilon_T], np.log10(A_start)])
+
+  def temperatures(x):
+    return x[0] * np.exp(x[1] * log_evolution) * frame
+
+  def residuals(x):
+    A = 10**x[2:]
+    return np.ravel(apply_whiten(greybody_kernel(A, temperatures(x), nu_in, betain, alphain)) - white_fluxes)
+
+  def jacobian_blocks(x):
+    T = temperatures(x)
+    A = 10**x[2:]
+    dS_dT = apply_whiten(greybody_kernel_dT(A, T, nu_in, betain, alphain))
+    dS_dlogA = np.log(10.) * apply_whiten(greybody_kernel(A, T, nu_in, betain, alphain))
+    return dS_dT * (T / x[0])[:,None], dS_dT * (T * log_evolution)[:,None], dS_dlogA
+
+  rows = np.arange(nb * nw)
+  cols = np.concatenate([np.zeros(nb * nw, dtype=int), np.ones(nb * nw, dtype=int), 2 + rows // nw])
+  def jacobian(x):
+    data = np.concatenate([np.ravel(block) for block in jacobian_blocks(x)])
+    return sparse.csr_matrix((data, (np.tile(rows, 3), cols)), shape=(nb * nw, 2 + nb))
+
+  result = least_squares(residuals, x0, jac = jacobian, method = 'trf', tr_solver = 'lsmr', x_scale = 'jac')
+  x = result.x
+  chi2 = np.sum(result.fun**2)
+  redchi = chi2 / max(nb * nw - 2 - nb, 1)
+
+  #Covariance from the arrow-shaped normal matrix [[G, C], [C^T, diag(d)]]
+  d_T0, d_eps, d_logA = jacobian_blocks(x)
+  G = np.array([[np.sum(d_T0 * d_T0), np.sum(d_T0 * d_eps)], [np.sum(d_T0 * d_eps), np.sum(d_eps * d_eps)]])
+  Cb = np.array([np.sum(d_T0 * d_logA, axis=1), np.sum(d_eps * d_logA, axis=1)]).T
+  d = np.sum(d_logA**2, axis=1)
+  schur_inv = np.linalg.inv(G - np.dot((Cb / d[:,None]).T, Cb))
+  var_logA = 1.0 / d + np.einsum('bk,kl,bl->b', Cb, schur_inv, Cb) / d**2
+  cov_global = schur_inv * redchi
+  err_A = np.log(10.) * 10**x[2:] * np.sqrt(var_logA * redchi)
+
+  m = Parameters()
+  m.add('T_0', value = x[0], vary = True)
+  m.add('epsilon_T', value = x[1], vary = True)
+  m['T_0'].stderr = np.sqrt(cov_global[0,0])
+  m['epsilon_T'].stderr = np.sqrt(cov_global[1,1])
+  for i in range(nb):
+    m.add('A_'+str(i), value = 10**x[2+i], vary = True)
+    m['A_'+str(i)].stderr = err_A[i]
+  return m
+
 ## V
 
 def viero_2013_luminosities(z,mass,sfg=1):